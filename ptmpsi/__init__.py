@@ -1,3 +1,14 @@
 __version__ = '0.1.0'
 
-from . import protein, nwchem, gromacs, alphafold
+import importlib
+
+# Submodules are imported on first access
+_submodules = ["protein", "nwchem", "gromacs", "alphafold"]
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("."+name,__name__)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__,name))
+
+def __dir__():
+    return sorted(set(globals()) | set(_submodules))
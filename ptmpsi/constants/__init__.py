@@ -4,6 +4,10 @@ nhbond     = 1.099
 pobond     = 1.56
 pnbond     = 1.56
 
+# Clash thresholds between heavy atoms and when a hydrogen is involved
+clashheavy    = 2.3
+clashhydrogen = 1.4
+
 ang2bohr = 1.8897259886
 eh2kjmol = 2625.5002
 nm2bohr  = ang2bohr*10.0
@@ -13,6 +17,7 @@ covrad = {
         "C": 0.76,
         "N": 0.71,
         "O": 0.66,
+        "P": 1.07,
         "S": 1.05,
         }
 
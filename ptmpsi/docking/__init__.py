@@ -2,11 +2,12 @@ import subprocess
 from shutil import which, copyfileobj
 from ptmpsi.exceptions import MyDockingError
 from ptmpsi.constants import nwchem_input
-from xyz2mol import xyz2mol, read_xyz_file
-from rdkit import Chem
-from meeko import MoleculePreparation, PDBQTMolecule
 
 def dock_ligand(protein,ligand,receptor,boxcenter,boxsize,output,flexible=None,charge=0):
+    # Heavy dependencies are only loaded when docking
+    from xyz2mol import xyz2mol, read_xyz_file
+    from rdkit import Chem
+    from meeko import MoleculePreparation
 
     # Check if prepare_ligand and prepare_receptor are in the path
     if which("prepare_ligand") is None:
@@ -40,16 +41,7 @@ def dock_ligand(protein,ligand,receptor,boxcenter,boxsize,output,flexible=None,c
 
     # Vina configuration file
     if boxcenter is None:
-        xcenter = 0; ycenter = 0; zcenter = 0
-        for chain in protein.chains:
-            for residue in chain.residues:
-                for xyz in residue.coordinates:
-                    xcenter += xyz[0]
-                    ycenter += xyz[1]
-                    zcenter += xyz[2]
-        xcenter /= protein.natoms
-        ycenter /= protein.natoms
-        zcenter /= protein.natoms
+        [xcenter,ycenter,zcenter] = protein.atoms.coordinates.mean(axis=0)
     else:
         [xcenter,ycenter,zcenter] = boxcenter
 
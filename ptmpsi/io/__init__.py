@@ -1,184 +1,153 @@
 import numpy as np
-from copy import deepcopy as copy
 from ptmpsi.math import resdist
+from ptmpsi.exceptions import MyDockingError
+
+def writefile(filename,text,compress=None):
+    """
+    Write text to a file in a single call. The file is gzip
+    compressed if requested or if its name ends in .gz
+    """
+    if compress is None:
+        compress = str(filename).endswith(".gz")
+    if compress:
+        import gzip
+        with gzip.open(filename,'wb') as fh:
+            fh.write(text.encode())
+    else:
+        with open(filename,'w') as fh:
+            fh.write(text)
+    return
 
-def writepdb(protein,pdbfile) :
-    with open(pdbfile,'w') as fh:
-        if protein.nssbonds > 0:
-            for i,ssbond in enumerate(protein.ssbonds):
-                fh.write("SSBOND {0: 3d} CYX {2} {1: 4d}    CYX {4} {3: 4d}{5: >43.2f}\n".format(i+1,*ssbond))
-        i = 0
-        for chain in protein.chains:
-            for residue in chain.residues:
-                for iatom in range(len(residue.names)):
-                    i += 1
-                    fh.write("ATOM  {:5d} {: >4s} {:3s} {:1s}{:4d}    {:8.3f}{:8.3f}{:8.3f}{: >24s}\n".format(i,residue.names[iatom],residue.name,residue.chain,residue.resid,*residue.coordinates[iatom],residue.elements[iatom]))
-            fh.write("TER\n")
-        fh.write("END")
+def writepdb(protein,pdbfile,compress=None) :
+    from ptmpsi.io.pdb import chainids, formatssbonds, formatatoms
+    mapping = chainids(protein)
+    writefile(pdbfile,formatssbonds(protein,mapping)+formatatoms(protein,mapping)+"END",compress)
     return
 
-def writexyz(protein,xyzfile):
-    with open(xyzfile,'w') as fh:
-        print(protein.natoms, file=fh)
-        print(" ", file=fh)
-        for chain in protein.chains:
-            for residue in chain.residues:
-                for iatom in range(len(residue.elements)):
-                    fh.write("{}  {: 16.8f}  {: 16.8f}  {: 16.8f}\n".format(residue.elements[iatom],*residue.coordinates[iatom]))
+def writexyz(protein,xyzfile,compress=None):
+    atoms = protein.atoms
+    values = np.empty((atoms.natoms,4),dtype=object)
+    values[:,0] = atoms.elements
+    values[:,1:] = atoms.coordinates
+    text = "{}\n \n".format(atoms.natoms) + ("%s  % 16.8f  % 16.8f  % 16.8f\n"*atoms.natoms) % tuple(values.ravel().tolist())
+    writefile(xyzfile,text,compress)
     return
 
 def digestpdb(protein,interactive=False,delwat=True,delhet=True):
-    protein.nonstandard = False
-    protein.missing     = False
-    nssbonds    = 0
-    ssbonds     = []
+    from ptmpsi.io.pdb import pdblines, records, readheader, readatoms, buildprotein
+
+    chars = pdblines(protein.pdbfile)
+    recs  = records(chars)
 
     # Look for metadata
-    for count,line in enumerate(protein.pdbfile):
-        if line.split()[0] == "MODRES":
-            protein.nonstandard = True
-            print("\t A modified residue is present")
-        if line.split()[0] == "SSBOND":
-            nssbonds += 1
-            ssbonds.append([int(line[17:21]),line[15:16],int(line[31:35]),line[29:30],float(line[73:78])])
-        if line.split()[0] in ["ATOM","HETATM"]:
-            start = count
-            break
-
-    dolast = True
-    resid = 0
-    nmissing = 0
-    natoms = 0
-    alternate = False
-    _chains = []
-    _residues = []
-    protein.nssbonds = nssbonds
-    protein.ssbonds = copy(ssbonds)
-    for line in protein.pdbfile[start:]:
-
-        # Skip ANISOU lines
-        if line.split()[0] == "ANISOU": continue
-
-        # Skip HETATM
-        if (delhet) and (line.split()[0] == 'HETATM'): continue
-
-        # Save last residue information
-        if line.split()[0] in ["TER","END","ENDMDL"] and dolast:
-            residue = protein.savessbond(ssbonds,residue,resid,nmissing,chain)
-            protein.addres(_residues,residue,atomid+1,names,elements,coordinates,chain,backbone)
-            _residues, natoms, resid, nmissing = protein.addchain(_chains,chain,_residues,natoms,resid,nmissing)
-            if line.split()[0] == "END": break
-            dolast = False
-            continue
-            
-        if line.split()[0] in ["ATOM", "HETATM"]:
-            # Check if we have a new chain
-            if len(_residues) == 0:
-                chain   = line[21:22]
-            # new chain was specified
-            elif line[21:22] != chain:
-                dolast = True
-                residue = protein.savessbond(ssbonds,residue,resid,nmissing,chain)
-                protein.addres(_residues,residue,atomid+1,names,elements,coordinates,chain,backbone)
-                _residues, natoms, resid, nmissing = protein.addchain(_chains,chain,_residues,natoms,resid,nmissing)
-                chain   = line[21:22]
-                    
-
-            # Check if we have a new residue
-            resnum  = int(line[23:26])
-            if resnum != resid + nmissing:
-                # Check if there are any missing internal residues
-                tmpid = nmissing + resid + 1
-                if tmpid != resnum:
-                    protein.missing = True
-                    if resid > 0:
-                        print("\t Missing internal residues")
-                    while tmpid != resnum:
-                        tmpid += 1
-                        nmissing += 1
-                # Add information from previous residue
-                if resid > 0:
-                    residue = protein.savessbond(ssbonds,residue,resid,nmissing,chain)
-                    protein.addres(_residues,residue,atomid+1,names,elements,coordinates,chain,backbone)
-                # Increase residue counter and restart fields
-                residue = line[17:20]
-                resid += 1
-                atomid = -1
-                names = []
-                elements = []
-                coordinates = []
-                alternate = False
-                backbone = np.empty(3,dtype=int)
-
-
-            # Read atom information
-            atom    = line[12:16].strip()
-            element = line[76:78].strip()
-
-            # Check for alternate locations
-            altcode = line[16:17]
-            if alternate:
-                if altcode != AorB:
-                    alternate = False
-                    continue
-            elif altcode in ["A","B"]:
-                alternate = True
-                print("\t Warning: Atom {} of residue {} has alternate locations".format(atom,residue+str(resid+nmissing)))
-                if interactive:
-                    AorB = input("\t\t Select 'A' or 'B': ")
-                    AorB = AorB.upper()
-                    if AorB not in ["A","B"]:
-                        raise ValueError("Did not understand alternate location: {}".format(AorB))
-                else:
-                    occupancy = float(line[54:60])
-                    AorB = "A" if occupancy >= 0.5 else "B"
-                    print("\t\t Selecting location '{}' with occupancy {:6.2f}".format(AorB,max(occupancy,1-occupancy)))
-                if altcode != AorB:
-                    continue
-
-            # Increase counters
-            atomid += 1
-            natoms += 1
-
-            # Append elements
-            names.append(atom)
-            elements.append(element)
-            coordinates.append([float(x) for x in line[30:54].split()])
-
-            # Define backbone
-            if atom == 'N':
-                backbone[0] = atomid
-            elif atom == 'CA':
-                backbone[1] = atomid
-            elif atom == 'C':
-                backbone[2] = atomid
-
-
-    # Save last residue information in case PDB file ended abruptly
-    if len(_residues) > 0:
-        residue = protein.savessbond(ssbonds,residue,resid,nmissing,chain)
-        protein.addres(_residues,residue,atomid+1,names,elements,coordinates,chain,backbone)
-        _residues,natoms,resid,nmissing = protein.addchain(_chains,chain,_residues,natoms,resid,nmissing)
-    protein.chains = copy(_chains)
-    protein.nchains = len(protein.chains)
-
-    # Remove water residues
-    if delwat: protein.delwaters()
+    start, protein.nonstandard, ssbonds = readheader(chars,recs)
+
+    # Atom records of the first model run until the first END or ENDMDL record
+    end = np.flatnonzero(np.isin(recs[start:],[b"END",b"ENDMDL"]))
+    stop = start + end[0] if len(end) > 0 else len(recs)
+    atoms = readatoms(chars[start:stop],recs[start:stop],delhet)
+
+    # Build chains and residues
+    keep = buildprotein(protein,atoms,ssbonds,interactive,delwat)
 
     # Update number of residues and atoms
     protein.update()
+    checkssbonds(protein)
+
+    return keep
+
+
+def digestcif(protein,interactive=False,delwat=True,delhet=True):
+    """
+    Same as digestpdb for mmCIF and BinaryCIF files. The Protein is
+    built from a columnar parse of the _atom_site category.
+    """
+    from ptmpsi.io.cif import readcif, readbcif, readsites, readheader
+    from ptmpsi.io.pdb import buildprotein
+
+    if protein.fileformat == "bcif":
+        categories = readbcif(protein.pdbfile)
+    else:
+        categories = readcif(protein.pdbfile)
+
+    # Look for metadata
+    protein.nonstandard, ssbonds = readheader(categories)
 
-    # Check SSBOND distance
+    # Build chains and residues
+    atoms = readsites(categories,delhet)
+    keep = buildprotein(protein,atoms,ssbonds,interactive,delwat)
+
+    # Update number of residues and atoms
+    protein.update()
+    checkssbonds(protein)
+
+    return keep
+
+
+def checkssbonds(protein):
+    """
+    Check SSBOND distances
+    """
     for issbond in protein.ssbonds:
-        for chain in protein.chains:
-            if chain.name == issbond[1]:
-                residue1 = chain.residues[issbond[0]-1]
-            if chain.name == issbond[3]:
-                residue2 = chain.residues[issbond[2]-1]
+        residue1 = protein.getchain(issbond[1]).residues[issbond[0]-1]
+        residue2 = protein.getchain(issbond[3]).residues[issbond[2]-1]
         _distance,atom1,atom2 = resdist(residue1,residue2)
         if np.isclose(_distance,issbond[4],0.1): continue
         print("\t Warning!!!")
         print("\t\t Expected SSBOND with {:4.2f} A bond length, but got {:4.2f} A instead".format(issbond[4],_distance))
+    return
 
 
+def readmodels(filename,interactive=False,delwat=True,delhet=True):
+    """
+    Generator over the models of a (multi-model) PDB file. Each model
+    is read and returned as a separate Protein, one at a time.
+    """
+    from ptmpsi.protein import Protein
+    from ptmpsi.io.pdb import splitmodels
+
+    with open(filename,'rb') as fh:
+        for model in splitmodels(fh):
+            protein = Protein()
+            protein.filename = filename
+            protein.pdbfile = model
+            digestpdb(protein,interactive,delwat,delhet)
+            protein.pdbfile = None
+            yield protein
     return
+
+
+def readensemble(filename,interactive=False,delwat=True,delhet=True):
+    """
+    Read all the models of a PDB file that share the same topology.
+    Returns a Protein built from the first model, and the coordinates
+    of all the models in a single (nmodels,natoms,3) array.
+    """
+    from ptmpsi.protein import Protein
+    from ptmpsi.io.pdb import splitmodels, pdblines, records, readatoms
+
+    protein = None
+    coordinates = []
+    with open(filename,'rb') as fh:
+        for imodel,model in enumerate(splitmodels(fh)):
+            # Topology from the first model
+            if protein is None:
+                protein = Protein()
+                protein.filename = filename
+                protein.pdbfile = model
+                keep = digestpdb(protein,interactive,delwat,delhet)
+                protein.pdbfile = None
+                names = protein.atoms.names
+                coordinates.append(protein.atoms.coordinates.copy())
+                continue
+
+            # Only coordinates from the rest of the models
+            chars = pdblines(model)
+            atoms = readatoms(chars,records(chars),delhet)
+            if (len(atoms["name"]) != len(keep)) or np.any(atoms["name"][keep] != names):
+                raise MyDockingError("Model {} does not have the same atoms as the first model".format(imodel+1))
+            coordinates.append(atoms["coordinates"][keep])
+
+    if protein is None:
+        raise MyDockingError("There are no models in {}".format(filename))
+    return protein, np.stack(coordinates)
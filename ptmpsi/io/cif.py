@@ -0,0 +1,212 @@
+import re
+import numpy as np
+from ptmpsi.exceptions import MyDockingError
+
+_TOKEN = re.compile(r"(?ms)^;(.*?)^;|'([^'\n]*)'(?!\S)|\"([^\"\n]*)\"(?!\S)|(\S+)")
+_STOP  = ("_","loop_","#","data_")
+
+
+def tokenize(text):
+    """
+    Split mmCIF values, taking care of quoted strings and text fields
+    """
+    if ("'" not in text) and ('"' not in text) and (";" not in text):
+        return text.split()
+    return [a or b or c or d for a,b,c,d in _TOKEN.findall(text)]
+
+
+def readcif(text):
+    """
+    Parse the first data block of an mmCIF file. Returns a dictionary
+    with the columns of every category, e.g. categories["atom_site"]["Cartn_x"].
+    The values of a loop are tokenized all at once and reshaped into columns.
+    """
+    if isinstance(text,(bytes,bytearray,memoryview)):
+        text = bytes(text).decode()
+    lines = text.splitlines()
+    nlines = len(lines)
+    categories = {}
+    blocks = 0
+
+    i = 0
+    while i < nlines:
+        line = lines[i]
+        if line.startswith("data_"):
+            blocks += 1
+            if blocks > 1: break
+            i += 1
+        elif line.startswith("loop_"):
+            keys = []
+            i += 1
+            while (i < nlines) and lines[i].startswith("_"):
+                keys.append(lines[i].split()[0])
+                i += 1
+            start = i
+            while (i < nlines) and not lines[i].startswith(_STOP):
+                i += 1
+            values = tokenize("\n".join(lines[start:i]))
+            if len(values) % len(keys) != 0:
+                raise MyDockingError("Wrong number of values in loop of {}".format(keys[0]))
+            values = np.array(values).reshape(-1,len(keys))
+            for ikey,key in enumerate(keys):
+                category, item = key[1:].split(".",1)
+                categories.setdefault(category,{})[item] = values[:,ikey]
+        elif line.startswith("_"):
+            tokens = tokenize(line)
+            i += 1
+            # Value in the following line(s)
+            if len(tokens) < 2:
+                start = i
+                if lines[i].startswith(";"):
+                    i += 1
+                    while not lines[i].startswith(";"): i += 1
+                i += 1
+                tokens += tokenize("\n".join(lines[start:i]))[:1]
+            category, item = tokens[0][1:].split(".",1)
+            categories.setdefault(category,{})[item] = np.array(tokens[1:2])
+        else:
+            i += 1
+
+    return categories
+
+
+_BYTEARRAY = { 1: '<i1', 2: '<i2', 3: '<i4', 4: '<u1', 5: '<u2', 6: '<u4', 32: '<f4', 33: '<f8' }
+
+
+def decode(data,encodings):
+    """
+    Decode a BinaryCIF column by applying its encodings in reverse order
+    """
+    for encoding in reversed(encodings):
+        kind = encoding["kind"]
+        if kind == "ByteArray":
+            data = np.frombuffer(data,dtype=_BYTEARRAY[encoding["type"]])
+        elif kind == "FixedPoint":
+            data = (data/encoding["factor"]).astype(_BYTEARRAY[encoding["srcType"]])
+        elif kind == "IntervalQuantization":
+            step = (encoding["max"]-encoding["min"])/(encoding["numSteps"]-1)
+            data = (encoding["min"] + step*data).astype(_BYTEARRAY[encoding["srcType"]])
+        elif kind == "RunLength":
+            data = np.repeat(data[0::2],data[1::2]).astype(_BYTEARRAY[encoding["srcType"]])
+        elif kind == "Delta":
+            data = (np.cumsum(data,dtype=np.int64) + encoding["origin"]).astype(_BYTEARRAY[encoding["srcType"]])
+        elif kind == "IntegerPacking":
+            # Values at the limits continue in the next element
+            data = data.astype(np.int64)
+            if encoding["isUnsigned"]:
+                limit = data == (2**(8*encoding["byteCount"])-1)
+            else:
+                upper = 2**(8*encoding["byteCount"]-1)
+                limit = (data == upper-1) | (data == -upper)
+            ends = np.flatnonzero(~limit)
+            data = np.add.reduceat(data,np.append(0,ends[:-1]+1))[:encoding["srcSize"]] if len(ends) > 0 else data[:0]
+            data = data.astype(np.int32)
+        elif kind == "StringArray":
+            offsets = decode(encoding["offsets"],encoding["offsetEncoding"])
+            strings = encoding["stringData"]
+            strings = np.array([strings[offsets[k]:offsets[k+1]] for k in range(len(offsets)-1)] + [""])
+            indices = decode(data,encoding["dataEncoding"])
+            data = strings[indices]
+        else:
+            raise MyDockingError("Unknown BinaryCIF encoding '{}'".format(kind))
+    return data
+
+
+def readbcif(data):
+    """
+    Parse the first data block of a BinaryCIF file into the same
+    dictionary of columns returned by readcif
+    """
+    try:
+        import msgpack
+    except ImportError:
+        raise MyDockingError("Reading BinaryCIF files requires the msgpack package")
+
+    block = msgpack.unpackb(bytes(data),raw=False)["dataBlocks"][0]
+    categories = {}
+    for _category in block["categories"]:
+        columns = {}
+        for column in _category["columns"]:
+            values = decode(column["data"]["data"],column["data"]["encoding"])
+            # Masked string values are either not present (.) or unknown (?)
+            if (column.get("mask") is not None) and (values.dtype.kind == "U"):
+                mask = decode(column["mask"]["data"],column["mask"]["encoding"])
+                values = np.where(mask == 1,".",np.where(mask == 2,"?",values))
+            columns[column["name"]] = values
+        categories[_category["name"].lstrip("_")] = columns
+    return categories
+
+
+def _first(columns,items,default=None):
+    for item in items:
+        if item in columns: return columns[item]
+    if default is None:
+        raise MyDockingError("Missing mmCIF item {}".format(items[0]))
+    return default
+
+
+def _blank(values):
+    values = np.asarray(values).astype(str)
+    return np.where(np.isin(values,[".","?"])," ",values)
+
+
+def readsites(categories,delhet=True):
+    """
+    Convert the _atom_site loop of the first model into the per-atom
+    columns used to build a Protein
+    """
+    if "atom_site" not in categories:
+        raise MyDockingError("There is no _atom_site category in the mmCIF file")
+    site = categories["atom_site"]
+    natoms = len(site["Cartn_x"])
+
+    select = np.ones(natoms,dtype=bool)
+    if "pdbx_PDB_model_num" in site:
+        model = np.asarray(site["pdbx_PDB_model_num"]).astype(int)
+        select &= model == model[0]
+    if delhet and ("group_PDB" in site):
+        select &= site["group_PDB"] == "ATOM"
+
+    atoms = {}
+    atoms["name"]    = np.asarray(_first(site,["auth_atom_id","label_atom_id"])).astype(str)[select]
+    atoms["altloc"]  = _blank(_first(site,["label_alt_id"],np.full(natoms,".")))[select]
+    atoms["resname"] = np.asarray(_first(site,["auth_comp_id","label_comp_id"])).astype(str)[select]
+    atoms["chain"]   = np.asarray(_first(site,["auth_asym_id","label_asym_id"])).astype(str)[select]
+    atoms["resnum"]  = np.asarray(_first(site,["auth_seq_id","label_seq_id"])).astype(int)[select]
+    atoms["icode"]   = _blank(_first(site,["pdbx_PDB_ins_code"],np.full(natoms,"?")))[select]
+    atoms["coordinates"] = np.column_stack([
+        np.asarray(site["Cartn_x"]).astype(float),
+        np.asarray(site["Cartn_y"]).astype(float),
+        np.asarray(site["Cartn_z"]).astype(float)])[select]
+    occupancy = np.asarray(_first(site,["occupancy"],np.full(natoms,"1.0"))).astype(str)
+    occupancy[np.isin(occupancy,[".","?"])] = "1.0"
+    atoms["occupancy"] = occupancy.astype(float)[select]
+    bfactor = np.asarray(_first(site,["B_iso_or_equiv"],np.full(natoms,"0.0"))).astype(str)
+    bfactor[np.isin(bfactor,[".","?"])] = "0.0"
+    atoms["bfactor"] = bfactor.astype(float)[select]
+    atoms["element"] = np.asarray(_first(site,["type_symbol"],np.full(natoms,""))).astype(str)[select]
+
+    # Entities (label_asym_id) play the role of TER records
+    asym = np.asarray(_first(site,["label_asym_id","auth_asym_id"])).astype(str)[select]
+    atoms["segment"] = np.cumsum(np.append(False,asym[1:] != asym[:-1]))
+    return atoms
+
+
+def readheader(categories):
+    """
+    Modified residues and disulfide bonds
+    """
+    nonstandard = False
+    for _ in _first(categories.get("pdbx_struct_mod_residue",{}),["id"],[]):
+        nonstandard = True
+        print("\t A modified residue is present")
+
+    ssbonds = []
+    conn = categories.get("struct_conn",{})
+    if "conn_type_id" in conn:
+        for iconn in np.flatnonzero(np.asarray(conn["conn_type_id"]).astype(str) == "disulf"):
+            distance = _first(conn,["pdbx_dist_value"],np.full(len(conn["conn_type_id"]),"0.0"))[iconn]
+            ssbonds.append([int(conn["ptnr1_auth_seq_id"][iconn]),str(conn["ptnr1_auth_asym_id"][iconn]),
+                            int(conn["ptnr2_auth_seq_id"][iconn]),str(conn["ptnr2_auth_asym_id"][iconn]),
+                            float(distance)])
+    return nonstandard, ssbonds
@@ -0,0 +1,325 @@
+import os
+import json
+import contextlib
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ptmpsi.exceptions import MyDockingError
+
+# Fetch settings, can be changed with configure() or environment variables
+settings = {
+    "cachedir": os.environ.get("PTMPSI_CACHE",os.path.join(os.path.expanduser("~"),".cache","ptmpsi")),
+    "maxsize":  int(os.environ.get("PTMPSI_CACHE_SIZE",2*1024**3)),
+    "offline":  os.environ.get("PTMPSI_OFFLINE","0").lower() in ["1","true","yes"],
+    "mirror":   os.environ.get("PTMPSI_MIRROR"),
+    "workers":  8,
+    "retries":  5,
+    "timeout":  60,
+}
+
+_rcsb      = "https://files.rcsb.org/download/{}.{}"
+_rcsbbcif  = "https://models.rcsb.org/{}.bcif"
+_alphafold = "https://alphafold.ebi.ac.uk/files/AF-{}-F1-model_v4.{}"
+
+_session = None
+_cache   = None
+_lock    = threading.Lock()
+
+
+def configure(**kwargs):
+    """
+    Change the fetch settings (cachedir, maxsize, offline, mirror,
+    workers, retries, timeout)
+    """
+    global _session, _cache
+    for key,value in kwargs.items():
+        if key not in settings:
+            raise MyDockingError("Unknown fetch setting '{}'".format(key))
+        settings[key] = value
+    with _lock:
+        _session = None
+        _cache = None
+    return
+
+
+class DownloadCache:
+    """
+    Content-addressed on-disk cache. Every file is stored once under the
+    SHA-256 of its contents, and an index maps download URLs to digests.
+    The modification time of the stored files tracks their last use, and
+    the least recently used files are evicted beyond maxsize bytes. The
+    index is merged with the one on disk when it is saved, so processes
+    sharing the directory keep each other's entries.
+    """
+    def __init__(self,directory,maxsize):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.objects = os.path.join(directory,"objects")
+        # Partial writes go here, so objects only holds complete files
+        self.tmp = os.path.join(directory,"tmp")
+        self.indexfile = os.path.join(directory,"index.json")
+        self.lock = threading.Lock()
+        os.makedirs(self.objects,exist_ok=True)
+        os.makedirs(self.tmp,exist_ok=True)
+        self.index = self.load()
+        # Keys added and digests removed since the last save
+        self.added = {}
+        self.removed = set()
+        self.batches = 0
+        # Running size of the objects, only rescanned to evict
+        self.total = sum(size for mtime,size,digest in self.scan())
+        return
+
+
+    def path(self,digest):
+        return os.path.join(self.objects,digest)
+
+
+    def get(self,key):
+        """
+        Return the cached contents of key, or None
+        """
+        with self.lock:
+            digest = self.index.get(key)
+        if digest is None: return None
+        try:
+            with open(self.path(digest),'rb') as fh:
+                data = fh.read()
+            os.utime(self.path(digest))
+        except FileNotFoundError:
+            return None
+        return data
+
+
+    def put(self,key,data):
+        """
+        Store data under key and return its digest. The index is saved
+        right away, unless within batch().
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        size = 0
+        if not os.path.isfile(path):
+            tmp = os.path.join(self.tmp,"{}.{}.{}".format(digest,os.getpid(),threading.get_ident()))
+            with open(tmp,'wb') as fh:
+                fh.write(data)
+            os.replace(tmp,path)
+            size = len(data)
+        with self.lock:
+            self.index[key] = digest
+            self.added[key] = digest
+            self.total += size
+            if self.total > self.maxsize:
+                self.evict()
+            if self.batches == 0:
+                self.save()
+        return digest
+
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Save the index once, at the end of a batch of puts
+        """
+        with self.lock:
+            self.batches += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batches -= 1
+                if self.batches == 0: self.save()
+
+
+    def load(self):
+        if not os.path.isfile(self.indexfile): return {}
+        try:
+            with open(self.indexfile,'r') as fh:
+                return json.load(fh)
+        except ValueError:
+            return {}
+
+
+    def save(self):
+        """
+        Merge the changes since the last save into the index on disk.
+        Must be called with the lock held.
+        """
+        if (len(self.added) == 0) and (len(self.removed) == 0): return
+        with _filelock(self.indexfile+".lock"):
+            index = self.load()
+            index.update(self.added)
+            index = { key: digest for key,digest in index.items() if digest not in self.removed }
+            tmp = os.path.join(self.tmp,"index.{}.{}".format(os.getpid(),threading.get_ident()))
+            with open(tmp,'w') as fh:
+                json.dump(index,fh)
+            os.replace(tmp,self.indexfile)
+        index.update(self.index)
+        self.index = { key: digest for key,digest in index.items() if digest not in self.removed }
+        self.added = {}
+        self.removed = set()
+        return
+
+
+    def scan(self):
+        """
+        Modification time, size and digest of every stored file
+        """
+        entries = []
+        for digest in os.listdir(self.objects):
+            if not _isdigest(digest): continue
+            # Other processes may remove files at the same time
+            try:
+                stat = os.stat(self.path(digest))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime,stat.st_size,digest))
+        return entries
+
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache fits in
+        maxsize, with a 10% margin so that the next puts do not have to
+        scan the directory again. Must be called with the lock held.
+        """
+        entries = self.scan()
+        self.total = sum(entry[1] for entry in entries)
+        if self.total <= self.maxsize: return
+        for mtime,size,digest in sorted(entries):
+            if self.total <= 0.9*self.maxsize: break
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                pass
+            self.removed.add(digest)
+            self.total -= size
+        self.index = { key: digest for key,digest in self.index.items() if digest not in self.removed }
+        self.added = { key: digest for key,digest in self.added.items() if digest not in self.removed }
+        return
+
+
+@contextlib.contextmanager
+def _filelock(filename):
+    # Advisory lock between processes, where available
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(filename,'a') as fh:
+        fcntl.flock(fh,fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh,fcntl.LOCK_UN)
+
+
+def _isdigest(name):
+    return (len(name) == 64) and all(char in "0123456789abcdef" for char in name)
+
+
+def cache():
+    """
+    Shared download cache
+    """
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = DownloadCache(settings["cachedir"],settings["maxsize"])
+    return _cache
+
+
+def session():
+    """
+    Shared HTTP session with a connection pool and retries
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(total=settings["retries"],backoff_factor=0.5,
+                          status_forcelist=[429,500,502,503,504],allowed_methods=["GET"])
+            adapter = HTTPAdapter(pool_connections=settings["workers"],pool_maxsize=settings["workers"],max_retries=retry)
+            _session = requests.Session()
+            _session.mount("https://",adapter)
+            _session.mount("http://",adapter)
+    return _session
+
+
+def structure_url(pdbid=None,uniprotid=None,fileformat="pdb"):
+    """
+    Download URL of a structure from the PDB or the AlphaFold database
+    """
+    if pdbid is not None:
+        if fileformat == "bcif":
+            return _rcsbbcif.format(pdbid.upper())
+        return _rcsb.format(pdbid.upper(),fileformat)
+    elif uniprotid is not None:
+        return _alphafold.format(uniprotid.upper(),fileformat)
+    raise MyDockingError("Provide a PDB or UniProt ID")
+
+
+def fetch_url(url):
+    """
+    Contents of a URL, looked up in the cache and the mirror before
+    downloading. The mirror is either a local directory, which is also
+    used in offline mode, or a base URL that replaces the original host.
+    """
+    store = cache()
+    data = store.get(url)
+    if data is not None: return data
+
+    mirror = settings["mirror"]
+    filename = url.rsplit("/",1)[1]
+    if (mirror is not None) and not mirror.startswith(("http://","https://")):
+        path = os.path.join(mirror,filename)
+        if os.path.isfile(path):
+            with open(path,'rb') as fh:
+                data = fh.read()
+            store.put(url,data)
+            return data
+
+    if settings["offline"]:
+        raise MyDockingError("{} is not available offline".format(filename))
+
+    source = url if (mirror is None) or not mirror.startswith(("http://","https://")) else mirror.rstrip("/")+"/"+filename
+    response = session().get(source,timeout=settings["timeout"])
+    response.raise_for_status()
+    data = response.content
+    store.put(url,data)
+    return data
+
+
+def fetch(pdbid=None,uniprotid=None,fileformat="pdb"):
+    """
+    Contents of a structure file from the PDB or the AlphaFold database
+    """
+    return fetch_url(structure_url(pdbid,uniprotid,fileformat))
+
+
+def fetch_many(ids,database="pdb",fileformat="pdb",workers=None):
+    """
+    Fetch many structures concurrently with a bounded thread pool.
+    database is either "pdb" or "alphafold". Returns a dictionary with
+    the contents of every file, or None if it could not be fetched.
+    """
+    if database not in ["pdb","alphafold"]:
+        raise MyDockingError("Unknown database '{}'".format(database))
+    if workers is None: workers = settings["workers"]
+
+    def _fetch(_id):
+        try:
+            if database == "pdb":
+                return fetch(pdbid=_id,fileformat=fileformat)
+            return fetch(uniprotid=_id,fileformat=fileformat)
+        except Exception as error:
+            print("\t Could not fetch {}: {}".format(_id,error))
+            return None
+
+    ids = list(ids)
+    with cache().batch(), ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_fetch,ids))
+    return dict(zip(ids,results))
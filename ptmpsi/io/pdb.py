@@ -0,0 +1,315 @@
+import string
+import numpy as np
+from ptmpsi.residues import Residue
+from ptmpsi.exceptions import MyDockingError
+
+_WATERS = ["HOH","WAT"]
+
+
+_ATOM = "ATOM  %5d %4s %-3s %-1s%4d    %8.3f%8.3f%8.3f%24s\n"
+
+
+def chainids(protein):
+    """
+    Single-character PDB chain identifier of every chain name of a
+    Protein. Longer names (mmCIF allows them) are mapped to the first
+    free character, with a warning.
+    """
+    names = [ str(chain.name) for chain in protein.chains ]
+    names += [ str(ssbond[k]) for ssbond in (protein.ssbonds or []) for k in [1,3] ]
+    used = { name for name in names if len(name) == 1 }
+    free = [ char for char in string.ascii_uppercase+string.ascii_lowercase+string.digits if char not in used ]
+    mapping = {}
+    for name in names:
+        if (len(name) == 1) or (name in mapping): continue
+        if len(free) == 0:
+            raise MyDockingError("Too many chains to write chain '{}' to a PDB file".format(name))
+        mapping[name] = free.pop(0)
+        print("\t Warning: chain '{}' is written as '{}' in the PDB file".format(name,mapping[name]))
+    return mapping
+
+
+def formatssbonds(protein,mapping=None):
+    """
+    SSBOND records of a Protein
+    """
+    if protein.nssbonds == 0: return ""
+    if mapping is None: mapping = chainids(protein)
+    ssbonds = [ [ mapping.get(str(value),value) if k in [1,3] else value for k,value in enumerate(ssbond) ]
+                for ssbond in protein.ssbonds ]
+    return "".join("SSBOND {0: 3d} CYX {2} {1: 4d}    CYX {4} {3: 4d}{5: >43.2f}\n".format(i+1,*ssbond)
+                   for i,ssbond in enumerate(ssbonds))
+
+
+def formatatoms(protein,mapping=None):
+    """
+    ATOM and TER records of all the chains in a Protein. The records of
+    each chain are formatted in bulk from the atom store columns with a
+    single %-formatting call. Chain names are mapped to single
+    characters with mapping (see chainids).
+    """
+    if mapping is None: mapping = chainids(protein)
+    atoms = protein.atoms
+    index = atoms.residue_index
+    values = np.empty((atoms.natoms,9),dtype=object)
+    values[:,0] = np.arange(1,atoms.natoms+1)
+    values[:,1] = atoms.names
+    values[:,2] = atoms.resnames[index]
+    values[:,3] = np.array([ mapping.get(str(name),name) for name in atoms.chainnames ],dtype=object)[index]
+    values[:,4] = atoms.resids[index]
+    values[:,5:8] = atoms.coordinates
+    values[:,8] = atoms.elements
+
+    records = []
+    for ichain in range(len(atoms.chains)):
+        start = atoms.resoffsets[atoms.choffsets[ichain]]
+        stop  = atoms.resoffsets[atoms.choffsets[ichain+1]]
+        records.append((_ATOM*(stop-start)) % tuple(values[start:stop].ravel().tolist()))
+        records.append("TER\n")
+    return "".join(records)
+
+
+def pdblines(pdbfile):
+    """
+    Return the lines of a PDB file as a fixed-width (nlines,80)
+    array of single bytes. pdbfile can be the raw bytes, a string
+    or a list of lines.
+    """
+    if isinstance(pdbfile,(bytes,bytearray,memoryview)):
+        data = bytes(pdbfile)
+    elif isinstance(pdbfile,str):
+        data = pdbfile.encode()
+    else:
+        data = "\n".join(line.rstrip("\r\n") for line in pdbfile).encode()
+    lines = np.array(data.splitlines(),dtype='S80')
+    return lines.view('S1').reshape(-1,80)
+
+
+def column(chars,start,stop):
+    """
+    Slice the fixed columns [start:stop) of all lines into
+    a single bytes array
+    """
+    return np.ascontiguousarray(chars[:,start:stop]).view('S{}'.format(stop-start)).ravel()
+
+
+def records(chars):
+    """
+    Record name of every line
+    """
+    return np.char.strip(column(chars,0,6))
+
+
+def readheader(chars,recs):
+    """
+    Parse the MODRES and SSBOND records that precede the first atom
+    """
+    atoms = np.flatnonzero((recs == b"ATOM") | (recs == b"HETATM"))
+    start = atoms[0] if len(atoms) > 0 else len(recs)
+
+    nonstandard = False
+    for _ in np.flatnonzero(recs[:start] == b"MODRES"):
+        nonstandard = True
+        print("\t A modified residue is present")
+
+    ssbonds = []
+    for iline in np.flatnonzero(recs[:start] == b"SSBOND"):
+        line = chars[iline].tobytes().decode()
+        ssbonds.append([int(line[17:21]),line[15:16],int(line[31:35]),line[29:30],float(line[73:78])])
+
+    return start, nonstandard, ssbonds
+
+
+def splitmodels(fh):
+    """
+    Yield the records of a PDB file one model at a time from a binary
+    file handle, so that only a single model is kept in memory. Header
+    records preceding the first model are prepended to every model.
+    """
+    header = []
+    model  = []
+    atoms  = False
+    inheader = True
+    for line in fh:
+        record = line[:6].strip()
+        if inheader:
+            if record not in [b"MODEL",b"ATOM",b"HETATM"]:
+                header.append(line)
+                continue
+            inheader = False
+        if record in [b"ENDMDL",b"END"]:
+            if atoms: yield b"".join(header+model)
+            model = []
+            atoms = False
+            if record == b"END": return
+        elif record != b"MODEL":
+            model.append(line)
+            atoms |= record in [b"ATOM",b"HETATM"]
+    if atoms: yield b"".join(header+model)
+    return
+
+
+def readatoms(chars,recs,delhet=True,terminators=(b"TER",)):
+    """
+    Slice the fixed PDB columns of all atom records into arrays.
+    Every terminator record starts a new chain segment.
+    """
+    isatom = recs == b"ATOM"
+    if not delhet:
+        isatom |= recs == b"HETATM"
+    segment = np.cumsum(np.isin(recs,terminators))
+    rows = np.flatnonzero(isatom)
+    lines = chars[rows]
+
+    atoms = {}
+    atoms["name"]    = np.char.strip(column(lines,12,16).astype('U4'))
+    atoms["altloc"]  = column(lines,16,17).astype('U1')
+    atoms["resname"] = np.char.strip(column(lines,17,20).astype('U3'))
+    atoms["chain"]   = column(lines,21,22).astype('U1')
+    atoms["resnum"]  = column(lines,22,26).astype(int)
+    atoms["icode"]   = column(lines,26,27).astype('U1')
+    atoms["coordinates"] = np.column_stack([
+        column(lines,30,38).astype(float),
+        column(lines,38,46).astype(float),
+        column(lines,46,54).astype(float)])
+    occupancy = column(lines,54,60)
+    occupancy[np.char.strip(occupancy) == b""] = b"1.0"
+    atoms["occupancy"] = occupancy.astype(float)
+    bfactor = column(lines,60,66)
+    bfactor[np.char.strip(bfactor) == b""] = b"0.0"
+    atoms["bfactor"] = bfactor.astype(float)
+    atoms["element"] = np.char.strip(column(lines,76,78).astype('U2'))
+    atoms["segment"] = segment[rows]
+    return atoms
+
+
+def selectaltlocs(atoms,newres,interactive=False):
+    """
+    Keep a single alternate location for every run of atoms with
+    alternate locations 'A' or 'B'. The location is asked for in
+    interactive mode, otherwise the most occupied one is selected.
+    """
+    altloc = atoms["altloc"]
+    isalt  = np.isin(altloc,["A","B"])
+    if not np.any(isalt):
+        return np.ones(len(altloc),dtype=bool)
+
+    # A run starts at an alternate atom that does not follow another
+    # alternate atom of the same residue
+    runstart = isalt.copy()
+    runstart[1:] &= ~(isalt[:-1] & ~newres[1:])
+    starts = np.flatnonzero(runstart)
+    choice = np.empty(len(starts),dtype='U1')
+    for irun,iatom in enumerate(starts):
+        print("\t Warning: Atom {} of residue {} has alternate locations".format(
+            atoms["name"][iatom],atoms["resname"][iatom]+str(atoms["resnum"][iatom])))
+        if interactive:
+            AorB = input("\t\t Select 'A' or 'B': ")
+            AorB = AorB.upper()
+            if AorB not in ["A","B"]:
+                raise ValueError("Did not understand alternate location: {}".format(AorB))
+        else:
+            occupancy = atoms["occupancy"][iatom]
+            AorB = "A" if occupancy >= 0.5 else "B"
+            print("\t\t Selecting location '{}' with occupancy {:6.2f}".format(AorB,max(occupancy,1-occupancy)))
+        choice[irun] = AorB
+
+    run = np.cumsum(runstart) - 1
+    keep = ~isalt
+    keep[isalt] = altloc[isalt] == choice[run[isalt]]
+    return keep
+
+
+def buildprotein(protein,atoms,ssbonds,interactive=False,delwat=True):
+    """
+    Fill the chains and residues of a Protein from per-atom columns.
+    Chains start when the chain identifier or the segment changes, and
+    residues when the residue number or the insertion code changes.
+    Returns the mask of atom records kept in the Protein.
+    """
+    from ptmpsi.protein import Chain
+
+    natoms = len(atoms["name"])
+    newchain = np.ones(natoms,dtype=bool)
+    newchain[1:] = (atoms["chain"][1:] != atoms["chain"][:-1]) | (atoms["segment"][1:] != atoms["segment"][:-1])
+    newres = newchain.copy()
+    newres[1:] |= (atoms["resnum"][1:] != atoms["resnum"][:-1]) | (atoms["icode"][1:] != atoms["icode"][:-1])
+
+    # Select alternate locations and remove waters
+    keep = selectaltlocs(atoms,newres,interactive)
+    if delwat:
+        keep &= ~np.isin(atoms["resname"],_WATERS)
+    chainid = np.cumsum(newchain)[keep] - 1
+    resid = np.cumsum(newres)[keep] - 1
+    names = atoms["name"][keep]
+    elements = atoms["element"][keep]
+    coordinates = atoms["coordinates"][keep]
+
+    # First atom of every residue, and first residue of every chain
+    resstart = np.flatnonzero(np.diff(resid,prepend=-1))
+    resstop = np.append(resstart[1:],len(resid))
+    reschain = chainid[resstart]
+    chstart = np.flatnonzero(np.diff(reschain,prepend=-1))
+    chstop = np.append(chstart[1:],len(resstart))
+    resname = atoms["resname"][keep][resstart]
+    reschainname = atoms["chain"][keep][resstart]
+    resnum = atoms["resnum"][keep][resstart]
+    icode = atoms["icode"][keep][resstart]
+    # Residue B-factors (pLDDT in AlphaFold models) are averaged over atoms
+    bfactor = np.add.reduceat(atoms["bfactor"][keep],resstart)/(resstop-resstart) if len(resstart) > 0 else np.empty(0)
+
+    # Missing residues
+    protein.missing = False
+    for ichain in range(len(chstart)):
+        numbers = resnum[chstart[ichain]:chstop[ichain]]
+        if numbers[0] > 1: protein.missing = True
+        for gap in np.flatnonzero(np.diff(numbers) > 1):
+            protein.missing = True
+            print("\t Missing internal residues")
+
+    # Backbone atoms, the last occurrence within a residue wins
+    local = np.arange(len(resid)) - resstart[resid]
+    backbone = np.zeros((len(resstart),3),dtype=int)
+    for ipos,atom in enumerate(["N","CA","C"]):
+        found = np.flatnonzero(names == atom)
+        backbone[resid[found],ipos] = local[found]
+
+    # SSBOND partners become CYX and get sequential residue numbers
+    protein.nssbonds = len(ssbonds)
+    protein.ssbonds = [list(ssbond) for ssbond in ssbonds]
+    if protein.nssbonds > 0:
+        sequential = {}
+        iscys = np.isin(resname,["CYS","CYX"])
+        for ichain in range(len(chstart)):
+            for ires in range(chstart[ichain],chstop[ichain]):
+                if not iscys[ires]: continue
+                sequential.setdefault((reschainname[ires],resnum[ires]),(ires,ires-chstart[ichain]+1))
+        for issbond,ssbond in enumerate(ssbonds):
+            for ipos in [0,2]:
+                partner = sequential.get((ssbond[ipos+1],ssbond[ipos]))
+                if partner is None: continue
+                resname[partner[0]] = "CYX"
+                protein.ssbonds[issbond][ipos] = int(partner[1])
+
+    # Build chains and residues
+    chains = []
+    for ichain in range(len(chstart)):
+        _chain = Chain(reschainname[chstart[ichain]])
+        _chain.residues = []
+        for ires in range(chstart[ichain],chstop[ichain]):
+            start, stop = resstart[ires], resstop[ires]
+            _residue = Residue(resname[ires],stop-start)
+            _residue.names = names[start:stop]
+            _residue.elements = elements[start:stop]
+            _residue.coordinates = coordinates[start:stop]
+            _residue.chain = _chain.name
+            _residue.backbone = backbone[ires]
+            _residue.resid = ires - chstart[ichain] + 1
+            _residue.resnum = int(resnum[ires])
+            _residue.icode = icode[ires].strip()
+            _residue.bfactor = float(bfactor[ires])
+            _chain.residues.append(_residue)
+        chains.append(_chain)
+
+    protein.chains = chains
+    return keep
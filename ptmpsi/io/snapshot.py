@@ -0,0 +1,186 @@
+import json
+import numpy as np
+from ptmpsi.exceptions import MyDockingError
+
+# Snapshot layout: magic, header length (uint64), JSON header, and the raw
+# arrays aligned to _ALIGN bytes at the offsets listed in the header
+_MAGIC   = b"PTMPSNAP"
+_VERSION = 1
+_ALIGN   = 64
+
+
+def _padding(position):
+    return (-position) % _ALIGN
+
+
+def savesnapshot(protein,filename):
+    """
+    Save a Protein into a binary snapshot with its contiguous atom
+    columns, residue and chain offsets, SSBOND records and charge.
+    """
+    header, arrays = snapshotarrays(protein)
+    writecontainer(filename,header,arrays)
+    return
+
+
+def snapshotarrays(protein):
+    """
+    Header and arrays of the snapshot of a Protein
+    """
+    atoms = protein.atoms
+    residues = atoms.residues
+    arrays = {
+        "coordinates": np.ascontiguousarray(atoms.coordinates,dtype='<f8'),
+        "names":       atoms.names.astype(str),
+        "elements":    atoms.elements.astype(str),
+        "resoffsets":  atoms.resoffsets.astype('<i8'),
+        "choffsets":   atoms.choffsets.astype('<i8'),
+        "resnames":    atoms.resnames,
+        "resids":      atoms.resids.astype('<i8'),
+        "reschains":   atoms.chainnames.astype(str),
+        "resnums":     np.array([getattr(residue,"resnum",residue.resid) for residue in residues],dtype='<i8'),
+        "icodes":      np.array([getattr(residue,"icode","") for residue in residues],dtype='U1'),
+        "bfactors":    np.array([getattr(residue,"bfactor",0.0) for residue in residues],dtype='<f8'),
+        "backbone":    np.array([residue.backbone for residue in residues],dtype='<i8').reshape(-1,3),
+        "chains":      np.array([chain.name for chain in atoms.chains],dtype=str),
+    }
+
+    header = {
+        "version": _VERSION,
+        "protein": {
+            "filename":    protein.filename,
+            "pdbid":       protein.pdbid,
+            "uniprotid":   protein.uniprotid,
+            "fileformat":  getattr(protein,"fileformat","pdb"),
+            "nonstandard": protein.nonstandard,
+            "missing":     protein.missing,
+            "charge":      None if protein.charge is None else float(protein.charge),
+            "ssbonds":     [[int(s[0]),str(s[1]),int(s[2]),str(s[3]),float(s[4])] for s in (protein.ssbonds or [])],
+        },
+    }
+    return header, arrays
+
+
+def readsnapshot(filename,mmap=True):
+    """
+    Read the header and arrays of a snapshot. The file is memory mapped
+    (copy-on-write) if mmap is True, so arrays are only loaded from disk
+    when accessed.
+    """
+    header, arrays = readcontainer(filename,mmap)
+    if header["version"] > _VERSION:
+        raise MyDockingError("Snapshot version {} is not supported".format(header["version"]))
+    return header, arrays
+
+
+def writecontainer(filename,header,arrays,magic=_MAGIC):
+    """
+    Write a JSON header and a dictionary of arrays into a single file,
+    with every array aligned so it can be mapped back without copies
+    """
+    header = dict(header)
+    header["arrays"] = {}
+
+    # Array offsets depend on the header size, iterate until they are stable
+    offset = 0
+    while True:
+        position = offset
+        for name,array in arrays.items():
+            header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": position}
+            position += array.nbytes + _padding(array.nbytes)
+        encoded = json.dumps(header).encode()
+        start = len(magic) + 8 + len(encoded)
+        start += _padding(start)
+        if start == offset: break
+        offset = start
+
+    with open(filename,'wb') as fh:
+        fh.write(magic)
+        fh.write(np.uint64(len(encoded)).astype('<u8').tobytes())
+        fh.write(encoded)
+        fh.write(b"\0"*(offset - fh.tell()))
+        for name,array in arrays.items():
+            fh.write(np.ascontiguousarray(array).tobytes())
+            fh.write(b"\0"*_padding(array.nbytes))
+    return
+
+
+def readcontainer(filename,mmap=True,magic=_MAGIC):
+    """
+    Read a file written by writecontainer in a single read, or a single
+    copy-on-write memory map. Returns the header and the arrays, which
+    are views into the mapped (or read) buffer.
+    """
+    if mmap:
+        buffer = np.memmap(filename,dtype=np.uint8,mode='c').view(np.ndarray)
+    else:
+        with open(filename,'rb') as fh:
+            buffer = np.frombuffer(bytearray(fh.read()),dtype=np.uint8)
+
+    if buffer[:len(magic)].tobytes() != magic:
+        raise MyDockingError("{} has the wrong file type".format(filename))
+    length = int(buffer[len(magic):len(magic)+8].view('<u8')[0])
+    header = json.loads(buffer[len(magic)+8:len(magic)+8+length].tobytes())
+
+    arrays = {}
+    for name,spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        shape = tuple(spec["shape"])
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        arrays[name] = buffer[spec["offset"]:spec["offset"]+nbytes].view(dtype).reshape(shape)
+    return header, arrays
+
+
+def loadsnapshot(filename,mmap=True):
+    """
+    Rebuild a Protein from a binary snapshot. The residues are views
+    into the atom store built directly from the snapshot columns.
+    """
+    header, arrays = readsnapshot(filename,mmap)
+    return buildsnapshot(header,arrays)
+
+
+def buildsnapshot(header,arrays):
+    """
+    Rebuild a Protein from the header and arrays of a snapshot,
+    binding its residues to the given columns without copies
+    """
+    from ptmpsi.protein import Protein, Chain
+    from ptmpsi.protein.store import AtomStore
+    from ptmpsi.residues import Residue
+
+    protein = Protein()
+    for key,value in header["protein"].items():
+        setattr(protein,key,value)
+    protein.nssbonds = len(protein.ssbonds)
+
+    resoffsets = arrays["resoffsets"]
+    choffsets  = arrays["choffsets"]
+    natoms     = np.diff(resoffsets).tolist()
+    resnames   = arrays["resnames"].tolist()
+    resids     = arrays["resids"].tolist()
+    resnums    = arrays["resnums"].tolist()
+    icodes     = arrays["icodes"].tolist()
+    bfactors   = arrays["bfactors"].tolist() if "bfactors" in arrays else [0.0]*len(resnames)
+    reschains  = arrays["reschains"].tolist()
+
+    chains = []
+    for ichain,name in enumerate(arrays["chains"].tolist()):
+        _chain = Chain(name)
+        _chain.residues = []
+        for ires in range(choffsets[ichain],choffsets[ichain+1]):
+            _residue = Residue(resnames[ires],natoms[ires])
+            _residue.chain = reschains[ires]
+            _residue.resid = resids[ires]
+            _residue.resnum = resnums[ires]
+            _residue.icode = icodes[ires]
+            _residue.bfactor = bfactors[ires]
+            _residue.backbone = arrays["backbone"][ires]
+            _chain.residues.append(_residue)
+        chains.append(_chain)
+    protein.chains = chains
+    protein.update()
+
+    # Bind the residues to the snapshot columns
+    protein._atoms = AtomStore(protein,arrays["coordinates"],arrays["names"],arrays["elements"])
+    return protein
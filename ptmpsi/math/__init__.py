@@ -1,6 +1,7 @@
 import numpy as np
 from copy import deepcopy as copy
-from ptmpsi.constants import amidebond, nhbond, amideangle
+from ptmpsi.constants import amidebond, nhbond, amideangle, covrad
+from ptmpsi.math.neighbors import NeighborIndex, atomflags, clashing
 
 aminolist = [
             "ACE",
@@ -41,14 +42,9 @@ def resdist(residue1,residue2):
     """
     Computes the minimum distance between two residues
     """
-    distance = np.finfo(np.float).max
-    for iatom,icoor in enumerate(residue1.coordinates):
-        for jatom,jcoor in enumerate(residue2.coordinates):
-            _distance = np.linalg.norm(icoor-jcoor)
-            if _distance < distance:
-                distance = _distance
-                ipos = iatom
-                jpos = jatom
+    distances = np.linalg.norm(residue1.coordinates[:,None,:]-residue2.coordinates[None,:,:],axis=-1)
+    ipos, jpos = np.unravel_index(np.argmin(distances),distances.shape)
+    distance = distances[ipos,jpos]
     return distance,ipos,jpos
 
 ####
@@ -91,6 +87,7 @@ def appendc(chain,residue,psi=None):
 
     # Find C-terminus
     cterminus = chain.residues[-1]
+    cterminus._checkpoint()
     if cterminus.name in ["NME","NHE"]:
         print("\t Warning: a new residue cannot be appended to '{}'".format(cterminus.name))
         print("\t\t Nothing will be done!")
@@ -163,6 +160,7 @@ def appendc(chain,residue,psi=None):
             dihedral = -np.radians(dihedral)
             R = rotmataxis(cterminus.find_coord("C")-cterminus.find_coord("CA"),dihedral)
             newcoords = np.dot(newcoords-cterminus.find_coord("CA"),R.T) + cterminus.find_coord("CA")
+            cterminus._unshare()
             cterminus.coordinates[cterminus.find("O")] = np.dot(R,cterminus.find_coord("O")-cterminus.find_coord("CA")) + cterminus.find_coord("CA")
 
 
@@ -191,6 +189,7 @@ def prependn(chain,residue,phi=None):
 
     # Find N-terminus
     nterminus = chain.residues[0]
+    nterminus._checkpoint()
     if nterminus.name in ["ACE"]:
         print("\t Warning: A new residue cannot be prepended to '{}'".format(nterminus.name))
         print("\t\t Nothing will be done!")
@@ -248,6 +247,7 @@ def prependn(chain,residue,phi=None):
 
     # Add hydrogen antiparallel to carbonyl
     vector1 = nerf(newcoords[residue.find("O")],newcoords[residue.find("C")],n,nhbond,120,180)
+    nterminus._unshare()
     nterminus.coordinates[hpos] = copy(vector1)
     nterminus.backbone[0] = nterminus.find("N")
     nterminus.backbone[1] = nterminus.find("CA")
@@ -384,116 +384,199 @@ def alignres(residue1,residue2):
 
 
 
-def rotate_chi1(residue,atoms,chi1):
-    if (atoms is None) or (chi1 == 0): return
-    tmp = residue.coordinates[atoms] - residue.coordinates[atoms[1]]
-    angle = -np.radians(chi1)
-    R = rotmataxis(tmp[2],angle)
-    mask = []
-    for i,name in enumerate(residue.names):
-        if name in ["N","H","CA","HA","C","O"]: continue
-        mask.append(i)
-    residue.coordinates[mask] = np.dot(residue.coordinates[mask]-residue.coordinates[atoms[1]],R.T) + residue.coordinates[atoms[1]]
-
-    internal = False
-    for iatom in range(len(residue.coordinates)):
-        for jatom in range(iatom+1,len(residue.coordinates)):
-            if np.linalg.norm(residue.coordinates[iatom] - residue.coordinates[jatom]) < 1.0:
-                internal = True
-                break
-    return internal
+def bonds(elements,coordinates):
+    """
+    Obtain the covalent bonds of a set of atoms from their distances
+    and covalent radii. Returns the adjacency list of every atom.
+    """
+    radii = np.array([covrad.get(str(element).strip().capitalize(),covrad["C"]) for element in elements])
+    distances = np.linalg.norm(coordinates[:,None,:]-coordinates[None,:,:],axis=-1)
+    bonded = distances < 1.2*(radii[:,None] + radii[None,:])
+    np.fill_diagonal(bonded,False)
+    return [np.flatnonzero(row) for row in bonded]
 
 
-def rotate_chi2(residue,atoms,chi2):
-    if (atoms is None) or (chi2 == 0): return
-    tmp = residue.coordinates[atoms] - residue.coordinates[atoms[1]]
-    angle = -np.radians(chi2)
-    R = rotmataxis(tmp[2],angle)
-    mask = []
-    for i,name in enumerate(residue.names):
-        if name in ["N","H","CA","HA","C","O","CB","HB","HB1","HB2","HB3"]: continue
-        if (residue.name == "ILE") and (name in ["CG2","HG21","HG22","HG23"]): continue
-        mask.append(i)
-    residue.coordinates[mask] = np.dot(residue.coordinates[mask]-residue.coordinates[atoms[1]],R.T) + residue.coordinates[atoms[1]]
+def moving_atoms(adjacency,axis):
+    """
+    Atoms that move when rotating about the bond axis=(b,c), i.e. all
+    atoms connected to c without going through b. Returns None if b
+    and c are part of the same ring.
+    """
+    b, c = int(axis[0]), int(axis[1])
+    visited = {c}
+    stack = [c]
+    while stack:
+        atom = stack.pop()
+        for neighbor in adjacency[atom]:
+            if (atom == c) and (neighbor == b): continue
+            if neighbor == b: return None
+            if neighbor in visited: continue
+            visited.add(neighbor)
+            stack.append(neighbor)
+    return np.array(sorted(visited),dtype=int)
+
+
+def template_bonds(names,elements,coordinates,template=None):
+    """
+    Covalent bonds of a residue from the connectivity of its template,
+    matching atoms by name. Atoms that are not in the template (e.g. a
+    PTM radical) are bonded by distance among themselves, and every
+    group of them to the single closest template atom it is bonded to
+    (the one it was attached to), so they never close spurious rings.
+    Without a template, all the bonds are taken from distances.
+    """
+    adjacency = bonds(elements,coordinates)
+    if template is None: return adjacency
+    tnames = [ str(name).strip() for name in template.elements[:,1] ]
+    tindex = dict(zip(reversed(tnames),range(len(tnames)-1,-1,-1)))
+    names = [ str(name).strip() for name in names ]
+    position = dict(zip(reversed(names),range(len(names)-1,-1,-1)))
+    # Repeated names beyond the first are not template atoms
+    mapped = [ tindex.get(name) if position[name] == iatom else None for iatom,name in enumerate(names) ]
+
+    result = []
+    for iatom,tatom in enumerate(mapped):
+        if tatom is None:
+            result.append({ j for j in adjacency[iatom] if mapped[j] is None })
+        else:
+            result.append({ position[tnames[t]] for t in template.adjacency[tatom] if tnames[t] in position })
+
+    # Attach every group of atoms outside the template once
+    seen = set()
+    for start,tatom in enumerate(mapped):
+        if (tatom is not None) or (start in seen): continue
+        group, stack = [], [start]
+        seen.add(start)
+        while stack:
+            iatom = stack.pop()
+            group.append(iatom)
+            for j in result[iatom]:
+                if j not in seen:
+                    seen.add(j)
+                    stack.append(j)
+        pairs = [ (np.linalg.norm(coordinates[i]-coordinates[j]),i,j) for i in group
+                  for j in adjacency[i] if mapped[j] is not None ]
+        if len(pairs) == 0: continue
+        distance, i, j = min(pairs)
+        result[i].add(j)
+        result[j].add(i)
+    return [ np.array(sorted(neighbors - {iatom}),dtype=int) for iatom,neighbors in enumerate(result) ]
+
+
+def torsion_tree(elements,coordinates,chis,names=None,template=None):
+    """
+    Compile the moving-atom index arrays of a list of dihedrals
+    from the bond connectivity (of the template, if given).
+    """
+    if template is None:
+        adjacency = bonds(elements,coordinates)
+    else:
+        adjacency = template_bonds(names,elements,coordinates,template)
+    return [moving_atoms(adjacency,chi[1:3]) for chi in chis]
 
-    internal = False
-    for iatom in range(len(residue.coordinates)):
-        for jatom in range(iatom+1,len(residue.coordinates)):
-            if np.linalg.norm(residue.coordinates[iatom] - residue.coordinates[jatom]) < 1.0:
-                internal = True
-                break
 
-    return internal
+def rotate_chi(residue,atoms,chi):
+    """
+    Rotate a dihedral of a residue by chi degrees, moving only the
+    atoms on the far side of the rotatable bond. Returns True if
+    the new conformation has internal overlaps.
+    """
+    if (atoms is None) or (chi == 0): return
+    origin = residue.coordinates[atoms[1]]
+    R = rotmataxis(residue.coordinates[atoms[2]]-origin,-np.radians(chi))
+    mask = residue.moving(atoms)
+    residue._unshare()
+    residue.coordinates[mask] = np.dot(residue.coordinates[mask]-origin,R.T) + origin
 
+    coordinates = residue.coordinates
+    i, j = np.triu_indices(len(coordinates),1)
+    return bool(np.any(np.linalg.norm(coordinates[i]-coordinates[j],axis=1) < 1.0))
 
-def find_clashes(proteins):
-    _all = []
-    nclashes = 0
 
-    for protein in proteins:
-        for chain in protein.chains:
-            _all += chain.residues
+def rotate_chi1(residue,atoms,chi1):
+    return rotate_chi(residue,atoms,chi1)
 
-    for iresidue in _all:
-        nclashes += find_clashes_residue(iresidue,proteins,allres=_all)
 
-    return
+def rotate_chi2(residue,atoms,chi2):
+    return rotate_chi(residue,atoms,chi2)
 
 
+clashdtype = np.dtype([
+    ("distance",float),
+    ("protein1",int), ("chain1","U4"), ("resname1","U4"), ("resid1",int), ("atom1","U4"),
+    ("protein2",int), ("chain2","U4"), ("resname2","U4"), ("resid2",int), ("atom2","U4")])
 
-def find_clashes_residue(iresidue,proteins,printing=True,allres=None):
 
-    _all = [] if allres is None else allres
+def find_clashes(proteins,printing=True):
+    """
+    Find all clashing atom pairs in a list of proteins. Every
+    unordered pair of atoms is checked once. Returns a structured
+    array (clashdtype) with one record per clash.
+    """
+    index = NeighborIndex(proteins)
+    i, j, distance = index.pairs()
 
-    _proteins = []
-    _iprotein = -1
-    nclashes = 0
-    for protein in proteins:
-        _iprotein += 1
-        for chain in protein.chains:
-            if allres is None: _all += chain.residues
-            for residue in chain.residues:
-                _proteins.append( _iprotein )
+    # Skip pairs within the same residue
+    mask = index.residue[i] != index.residue[j]
+    i, j, distance = i[mask], j[mask], distance[mask]
 
-    for jres in range(len(_all)):
-        jresidue = _all[jres]
-        if jresidue == iresidue: continue
-        ires = jres
+    mask = clashing(index.flags[i],index.resid[i],index.chain[i],
+                    index.flags[j],index.resid[j],index.chain[j],distance)
+    i, j, distance = i[mask], j[mask], distance[mask]
 
-        # Test if residues are contiguous
-        _samechain = iresidue.chain == jresidue.chain
-        _contiguous = _samechain and (abs(iresidue.resid-jresidue.resid) == 1)
+    # Report in atom order
+    order = np.lexsort((j,i))
+    i, j, distance = i[order], j[order], distance[order]
 
-        # Random distance
-        _distance = np.linalg.norm(iresidue.coordinates[0]-jresidue.coordinates[0])
+    clashes = np.empty(len(i),dtype=clashdtype)
+    clashes["distance"] = distance
+    for suffix,k in (("1",i),("2",j)):
+        clashes["protein"+suffix] = index.protein[k] + 1
+        clashes["chain"+suffix]   = index.chain[k]
+        clashes["resname"+suffix] = index.resname[k]
+        clashes["resid"+suffix]   = index.resid[k]
+        clashes["atom"+suffix]    = index.names[k]
 
-        # If large, it is safe to assume no clashes between residues
-        if _distance > 10.0: continue
+    if printing:
+        for clash in clashes:
+            print("\t Warning: Possible clash, distance: {:8.3f} A".format(clash["distance"]))
+            print("\t\t Atom {}:{}:{}{}:{} and {}:{}:{}{}:{}".format(*clash.tolist()[1:]))
+        print("\t Found {} possible clashes".format(len(clashes)))
 
-        for iatom,iname in enumerate(iresidue.names):
-            _sg = iname == "SG"
-            _n  = iname in ["N","H"]
-            _c  = iname in ["C","O"] 
-            _ih = iname[0] == "H"
-            for jatom,jname in enumerate(jresidue.names):
-                _ssbond = _sg and jname == "SG"
-                _amide  = _contiguous and ((_n and jname in ["C","O","CA"]) or (_c and jname in ["N","H","CA"]))
-                _jh     = jname[0] == "H"
+    return clashes
 
-                # Skip amide bonds and possible ssbonds
-                if _amide or _ssbond: continue
 
-                # Get distance between atoms
-                _distance = np.linalg.norm(iresidue.coordinates[iatom]-jresidue.coordinates[jatom])
-                # Heavy atoms, longer threshold
-                threshold = 1.4 if (_ih or _jh) else 2.3
 
-                if _distance < threshold:
-                    nclashes += 1
-                    if not printing: continue
-                    print("\t Warning: Possible clash, distance: {:8.3f} A".format(_distance))
-                    print("\t\t Atom {}:{}:{}{}:{} and {}:{}:{}{}:{}".format(
-                        _proteins[ires]+1,iresidue.chain,iresidue.name,str(iresidue.resid),iresidue.names[iatom],
-                        _proteins[jres]+1,jresidue.chain,jresidue.name,str(jresidue.resid),jresidue.names[jatom]))
+def find_clashes_residue(iresidue,proteins,printing=True,index=None):
+    """
+    Count the atoms in the proteins that clash with iresidue.
+    A prebuilt NeighborIndex of the proteins can be passed to
+    avoid rebuilding it on repeated calls. Otherwise, only the
+    atoms around iresidue are indexed. Only the atoms of
+    iresidue are taken from its current coordinates.
+    """
+    if index is None:
+        index = NeighborIndex(proteins,iresidue.coordinates)
+
+    # Candidate pairs within the largest threshold
+    iatom, jatom, distance = index.query(iresidue.coordinates)
+
+    # Skip atoms from the residue itself
+    same = ((index.resid[jatom] == iresidue.resid) &
+            (index.chain[jatom] == iresidue.chain) &
+            (index.resname[jatom] == iresidue.name))
+    iflags = atomflags(iresidue.names)[iatom]
+    mask = ~same & clashing(iflags,iresidue.resid,iresidue.chain,
+                            index.flags[jatom],index.resid[jatom],index.chain[jatom],distance)
+    nclashes = int(np.count_nonzero(mask))
+
+    if printing and (nclashes > 0):
+        iatom, jatom, distance = iatom[mask], jatom[mask], distance[mask]
+        for k in np.lexsort((jatom,iatom,index.residue[jatom])):
+            j = jatom[k]
+            print("\t Warning: Possible clash, distance: {:8.3f} A".format(distance[k]))
+            print("\t\t Atom {}:{}:{}{}:{} and {}:{}:{}{}:{}".format(
+                index.protein[j]+1,iresidue.chain,iresidue.name,str(iresidue.resid),iresidue.names[iatom[k]],
+                index.protein[j]+1,index.chain[j],index.resname[j],str(index.resid[j]),index.names[j]))
 
     return nclashes
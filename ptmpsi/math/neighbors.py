@@ -0,0 +1,142 @@
+import numpy as np
+from ptmpsi.constants import clashheavy, clashhydrogen
+
+
+class NeighborIndex:
+    """
+    Flat table with all the atoms of a list of proteins, together
+    with a KD-tree to retrieve the atoms close to a set of points.
+    If around is given, only the atoms in the bounding box of those
+    coordinates, widened by cutoff, are indexed.
+    """
+    def __init__(self,proteins,around=None,cutoff=clashheavy):
+        coordinates = []
+        names       = []
+        residue     = []
+        resid       = []
+        resname     = []
+        chain       = []
+        protein     = []
+        self.residues = []
+        for iprotein,_protein in enumerate(proteins):
+            atoms = _protein.atoms
+            index = atoms.residue_index
+            if around is None:
+                coordinates.append(atoms.coordinates)
+                names.append(atoms.names)
+                resid.append(atoms.resids[index])
+                resname.append(atoms.resnames[index])
+                chain.append(atoms.chainnames[index])
+            else:
+                # Per-residue columns are only gathered for the selected atoms
+                select = inside(atoms.coordinates,around,cutoff)
+                index = index[select]
+                present, inverse = np.unique(index,return_inverse=True)
+                residues = [atoms.residues[ires] for ires in present]
+                coordinates.append(atoms.coordinates[select])
+                names.append(atoms.names[select])
+                resid.append(np.array([_residue.resid for _residue in residues],dtype=int)[inverse])
+                resname.append(np.array([_residue.name for _residue in residues],dtype='U4')[inverse])
+                chain.append(np.array([_residue.chain for _residue in residues],dtype=str)[inverse])
+            residue.append(index + len(self.residues))
+            protein.append(np.full(len(index),iprotein,dtype=int))
+            self.residues += atoms.residues
+
+        if sum(len(x) for x in coordinates) == 0:
+            self.coordinates = np.empty((0,3),dtype=float)
+            self.names   = np.empty(0,dtype='U4')
+            self.residue = np.empty(0,dtype=int)
+            self.resid   = np.empty(0,dtype=int)
+            self.resname = np.empty(0,dtype='U4')
+            self.chain   = np.empty(0,dtype='U4')
+            self.protein = np.empty(0,dtype=int)
+        else:
+            self.coordinates = np.concatenate(coordinates)
+            self.names   = np.concatenate(names)
+            self.residue = np.concatenate(residue)
+            self.resid   = np.concatenate(resid)
+            self.resname = np.concatenate(resname)
+            self.chain   = np.concatenate(chain)
+            self.protein = np.concatenate(protein)
+        self.flags  = atomflags(self.names)
+        self.natoms = len(self.coordinates)
+        from scipy.spatial import cKDTree
+        self.tree = cKDTree(self.coordinates)
+        return
+
+
+    def query(self,coordinates,cutoff=clashheavy):
+        """
+        Return all pairs (i,j,distance) between the given coordinates
+        and the atoms in the index that are closer than cutoff.
+        """
+        if (self.natoms == 0) or (len(coordinates) == 0):
+            return np.empty(0,dtype=int), np.empty(0,dtype=int), np.empty(0,dtype=float)
+        from scipy.spatial import cKDTree
+        pairs = cKDTree(coordinates).sparse_distance_matrix(self.tree,cutoff,output_type='ndarray')
+        return pairs['i'].astype(int), pairs['j'].astype(int), pairs['v']
+
+
+    def pairs(self,cutoff=clashheavy):
+        """
+        Return all unordered pairs (i,j,distance), i < j, of atoms in
+        the index that are closer than cutoff. Each pair is visited once.
+        """
+        pairs = self.tree.query_pairs(cutoff,output_type='ndarray')
+        if len(pairs) == 0:
+            return np.empty(0,dtype=int), np.empty(0,dtype=int), np.empty(0,dtype=float)
+        i, j = pairs[:,0], pairs[:,1]
+        distances = np.linalg.norm(self.coordinates[i]-self.coordinates[j],axis=1)
+        return i, j, distances
+
+
+def inside(coordinates,around,cutoff):
+    """
+    Indices of the coordinates within the bounding box of around,
+    widened by cutoff in every direction
+    """
+    around = np.asarray(around,dtype=float).reshape(-1,3)
+    if len(around) == 0:
+        return np.empty(0,dtype=int)
+    lower = around.min(axis=0) - cutoff
+    upper = around.max(axis=0) + cutoff
+    return np.flatnonzero(np.all((coordinates >= lower) & (coordinates <= upper),axis=1))
+
+
+def atomflags(names):
+    """
+    Per-atom flags used by the clash criteria
+    """
+    names = np.asarray(names).astype(str)
+    flags = np.zeros(len(names),dtype=[("hydrogen",bool),("amiden",bool),("amidec",bool),("ca",bool),("sg",bool)])
+    flags["hydrogen"] = np.char.startswith(names,"H")
+    flags["amiden"] = np.isin(names,["N","H"])
+    flags["amidec"] = np.isin(names,["C","O"])
+    flags["ca"] = names == "CA"
+    flags["sg"] = names == "SG"
+    return flags
+
+
+def clashthreshold(iflags,iresid,ichain,jflags,jresid,jchain):
+    """
+    Distance below which a pair of atoms is considered a clash. Amide
+    bonds between contiguous residues and disulfide bonds are never
+    clashes (zero threshold), and pairs involving hydrogen atoms use
+    a shorter threshold.
+    """
+    hydrogen = iflags["hydrogen"] | jflags["hydrogen"]
+    threshold = np.where(hydrogen,clashhydrogen,clashheavy)
+    contiguous = (ichain == jchain) & (np.abs(iresid - jresid) == 1)
+    amide = contiguous & (
+            (iflags["amiden"] & (jflags["amidec"] | jflags["ca"])) |
+            (iflags["amidec"] & (jflags["amiden"] | jflags["ca"])))
+    ssbond = iflags["sg"] & jflags["sg"]
+    return np.where(amide | ssbond,0.0,threshold)
+
+
+def clashing(iflags,iresid,ichain,jflags,jresid,jchain,distances):
+    """
+    Apply the clash criteria to a list of atom pairs.
+    Returns a boolean mask over the pairs.
+    """
+    return distances < clashthreshold(iflags,iresid,ichain,jflags,jresid,jchain)
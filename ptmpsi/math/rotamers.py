@@ -0,0 +1,129 @@
+import numpy as np
+from ptmpsi.constants import clashheavy
+from ptmpsi.math.neighbors import atomflags, clashthreshold
+
+
+def rotmataxes(k,theta):
+    """
+    Vectorized version of rotmataxis. Obtain the rotation matrices
+    through the angles theta counterclockwise about the axes k.
+    k has shape (...,3) and theta is broadcast against k[...,0].
+    """
+    khat = k/np.linalg.norm(k,axis=-1,keepdims=True)
+    theta = np.asarray(theta,dtype=float)
+    shape = np.broadcast_shapes(khat.shape[:-1],theta.shape)
+    khat = np.broadcast_to(khat,shape+(3,))
+    theta = np.broadcast_to(theta,shape)
+    K = np.zeros(shape+(3,3))
+    K[...,0,1] = -khat[...,2]
+    K[...,0,2] =  khat[...,1]
+    K[...,1,0] =  khat[...,2]
+    K[...,1,2] = -khat[...,0]
+    K[...,2,0] = -khat[...,1]
+    K[...,2,1] =  khat[...,0]
+    sin = np.sin(theta)[...,None,None]
+    cos = np.cos(theta)[...,None,None]
+    return np.eye(3) + sin*K + (1-cos)*K@K
+
+
+def rotate_about(coordinates,origin,R):
+    """
+    Rotate coordinates (...,n,3) about origin (...,3) with the
+    rotation matrices R (...,3,3).
+    """
+    return np.einsum('...mj,...ij->...mi',coordinates-origin[...,None,:],R) + origin[...,None,:]
+
+
+def chi_rotamers(coordinates,chis,masks,step=30):
+    """
+    Generate all the conformers of a side chain on a regular grid of
+    its dihedrals in a single (K,n,3) array. masks holds the atoms that
+    move with each dihedral. Conformers are ordered with the first
+    dihedral as the slowest index, the first one being the unrotated
+    residue. Returns the conformers and the (K,nchis) grid of rotations.
+    """
+    angles = np.arange(0,360,step)
+    nangles = len(angles)
+    thetas = -np.radians(angles)
+    natoms = len(coordinates)
+
+    conformers = coordinates[None]
+    for chi,mask in zip(chis,masks):
+        # Rotate about the (already rotated) bond of this dihedral
+        nconf = len(conformers)
+        origin = conformers[:,chi[1]]
+        R = rotmataxes((conformers[:,chi[2]]-origin)[:,None,:],thetas[None,:])
+        conformers = np.repeat(conformers[:,None],nangles,axis=1)
+        conformers[:,:,mask] = rotate_about(conformers[:,:,mask],np.broadcast_to(origin[:,None],(nconf,nangles,3)),R)
+        conformers = conformers.reshape(nconf*nangles,natoms,3)
+
+    grid = np.stack(np.meshgrid(*[angles]*len(chis),indexing='ij'),axis=-1).reshape(-1,len(chis))
+    return conformers, grid
+
+
+def internal_overlaps(conformers,cutoff=1.0):
+    """
+    Flag the conformers in which any two atoms are closer than cutoff
+    """
+    natoms = conformers.shape[1]
+    i, j = np.triu_indices(natoms,1)
+    distances = np.linalg.norm(conformers[:,i]-conformers[:,j],axis=-1)
+    return np.any(distances < cutoff,axis=1)
+
+
+def count_clashes(residue,conformers,index,skip=None,batch=64):
+    """
+    Count the clashes of every conformer of residue against the atoms
+    in a NeighborIndex. The environment is extracted once around all
+    the conformers, and only the pairs of atoms closer than the clash
+    distance are retrieved from KD-trees, for batch conformers at a
+    time. Atoms of the index flagged in skip are ignored.
+    """
+    from scipy.spatial import cKDTree
+    clashes = np.zeros(len(conformers),dtype=int)
+    center = residue.coordinates.mean(axis=0)
+    radius = np.max(np.linalg.norm(conformers-center,axis=-1)) + clashheavy
+    env = np.array(index.tree.query_ball_point(center,radius),dtype=int)
+
+    # Skip atoms from the residue itself
+    same = ((index.resid[env] == residue.resid) &
+            (index.chain[env] == residue.chain) &
+            (index.resname[env] == residue.name))
+    env = env[~same]
+    if skip is not None:
+        env = env[~skip[env]]
+    if len(env) == 0:
+        return clashes
+
+    natoms = conformers.shape[1]
+    flags = atomflags(residue.names)
+    tree = cKDTree(index.coordinates[env])
+    for start in range(0,len(conformers),batch):
+        chunk = conformers[start:start+batch]
+        found = cKDTree(chunk.reshape(-1,3)).sparse_distance_matrix(tree,clashheavy,output_type='ndarray')
+        a, b = found['i'].astype(int), env[found['j'].astype(int)]
+        threshold = clashthreshold(flags[a%natoms],residue.resid,residue.chain,
+                                   index.flags[b],index.resid[b],index.chain[b])
+        mask = found['v'] < threshold
+        clashes[start:start+len(chunk)] = np.bincount(a[mask]//natoms,minlength=len(chunk))
+    return clashes
+
+
+def count_clashes_residues(residue,conformers,residues):
+    """
+    Count the clashes of every conformer of residue against the
+    current atoms of a (small) list of other residues
+    """
+    clashes = np.zeros(len(conformers),dtype=int)
+    center = residue.coordinates.mean(axis=0)
+    radius = np.max(np.linalg.norm(conformers-center,axis=-1)) + clashheavy
+    iflags = atomflags(residue.names)[:,None]
+    for other in residues:
+        if other is residue: continue
+        coordinates = other.coordinates
+        if np.min(np.linalg.norm(coordinates-center,axis=1)) > radius: continue
+        threshold = clashthreshold(iflags,residue.resid,residue.chain,
+                                   atomflags(other.names)[None,:],other.resid,other.chain)
+        distances = np.linalg.norm(conformers[:,:,None,:]-coordinates[None,None,:,:],axis=-1)
+        clashes += np.count_nonzero(distances < threshold,axis=(1,2))
+    return clashes
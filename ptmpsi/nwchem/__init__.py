@@ -4,7 +4,6 @@ from ptmpsi.nwchem.bonded import bondedks
 from ptmpsi.nwchem.reader import readoptim
 from ptmpsi.math import get_torsion
 from ptmpsi.constants import ang2bohr
-import copy
 import numpy as np
 import os
 
@@ -108,14 +107,14 @@ def get_qm_data(residue,ligand=False,ff="AMBER99",**kwargs):
     tdrive = TorsionDrive(**kwargs)
 
     # Generate the appropriate conformations
-    alpha = copy.deepcopy(residue)
+    alpha = residue.clone()
     if ligand:
         conformers = [alpha]
     else:
         alpha.prepend(chain="A",residue="ACE",phi=-60.0)
         alpha.append(chain="A",residue="NME",psi=-45.0)
         alpha = alpha.chains[0].residues
-        beta = copy.deepcopy(residue)
+        beta = residue.clone()
         beta.prepend(chain="A",residue="ACE",phi=-135.0)
         beta.append(chain="A",residue="NME",psi=135.0)
         beta = beta.chains[0].residues
@@ -279,7 +278,7 @@ def forcebalance(residue,**kwargs):
     suffix = kwargs.get("suffix","")
 
     # Generate a copy of the Residue
-    alpha = copy.deepcopy(residue)
+    alpha = residue.clone()
     alpha.prepend(chain="A",residue="ACE",phi=-60.0)
     alpha.append(chain="A",residue="NME",psi=-45.0)
     from ptmpsi.gromacs.utils import amber_to_gromacs_names
@@ -469,7 +468,7 @@ def torsionscan(elements,coordinates,torsions,ligand=False,charge=0,mult=1):
 
 
 def bonds_and_angles(protein,ligand=False):
-    alpha = copy.deepcopy(protein)
+    alpha = protein.clone()
     if not ligand:
         alpha.prepend(chain="A", residue="ACE", phi=-60)
         alpha.append(chain="A", residue="NME", psi=-45)
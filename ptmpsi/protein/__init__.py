@@ -1,104 +1,258 @@
-import requests
 import copy
 import numpy as np
 import subprocess
 from shutil import which
-from ..exceptions import FeatureError
+from ..exceptions import FeatureError, MyDockingError
 from ptmpsi.residues import resdict, Residue
 from ptmpsi.math import find_clashes, find_clashes_residue, appendc, prependn
 from ptmpsi.protein.mutate import point_mutation, post_translational_modification
-from ptmpsi.io import digestpdb, writepdb
+from ptmpsi.protein.mutate import point_mutations, post_translational_modifications
+from ptmpsi.protein.scan import saturation_mutagenesis, ptm_scan
+from ptmpsi.protein.crosstalk import PTMCombinations
+from ptmpsi.io import digestpdb, digestcif, writepdb
+from ptmpsi.io.snapshot import savesnapshot, loadsnapshot
+from ptmpsi.io.fetch import fetch
 from ptmpsi.docking import dock_ligand
+from ptmpsi.protein.store import AtomStore
+from ptmpsi.protein.index import ResidueIndex
+from ptmpsi.protein.journal import Transaction
 
 
 class Chain:
     def __init__(self,name):
+        self._protein  = None
         self.name = name
-        self.nresidues = 0
-        self.natoms    = 0
         self.residues  = None
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_protein"] = None
+        return state
+
+    def _column(self,column):
+        # View into the Protein atom store, if the chain is owned by one
+        if self._protein is not None:
+            atoms = self._protein.atoms
+            if atoms.has_chain(self):
+                return getattr(atoms,column)[atoms.chain_slice(self)]
+        # Otherwise, gather the residue arrays
+        if len(self.residues) == 0:
+            return np.empty((0,3),dtype=float) if column == "coordinates" else np.empty(0,dtype='U4')
+        return np.concatenate([getattr(residue,column) for residue in self.residues])
+
+    @property
+    def nresidues(self):
+        return 0 if self.residues is None else len(self.residues)
+
+    @property
+    def natoms(self):
+        # Counted from the Protein atom store, if the chain is owned by one
+        if self._protein is not None:
+            atoms = self._protein.atoms
+            if atoms.has_chain(self):
+                _slice = atoms.chain_slice(self)
+                return int(_slice.stop - _slice.start)
+        return sum(len(residue.coordinates) for residue in (self.residues or []))
+
+    @property
+    def coordinates(self):
+        return self._column("coordinates")
+
+    @property
+    def names(self):
+        return self._column("names")
+
+    @property
+    def elements(self):
+        return self._column("elements")
 
 
 class Protein:
-    def __init__(self,filename=None,pdbid=None,uniprotid=None,interactive=False,delwat=True,delhet=True):
+    def __init__(self,filename=None,pdbid=None,uniprotid=None,interactive=False,delwat=True,delhet=True,fileformat=None):
         self.filename = filename
         self.pdbid = pdbid
         self.uniprotid = uniprotid
         self.pdbfile = None
         self.chains = None
-        self.natoms = 0
-        self.nresidues = 0
         self.nonstandard = None
         self.missing     = None
         self.nssbonds = 0
         self.ssbonds = None
         self.charge = None
+        self._atoms = None
+        self._index = None
+        self._journal = []
+
+        # File format, guessed from the file extension if not given
+        if fileformat is None:
+            fileformat = "pdb"
+            if self.filename is not None:
+                for extension in ["cif","bcif"]:
+                    if self.filename.lower().endswith("."+extension): fileformat = extension
+        self.fileformat = fileformat.lower()
+        if self.fileformat not in ["pdb","cif","bcif"]:
+            raise MyDockingError("Unknown file format '{}'".format(fileformat))
         
-        # Download file from the PDB
+        # Download file from the PDB (or take it from the cache)
         if self.pdbid is not None:
             print("\t Downloading file from the Protein Databank")
-            response = requests.get("https://files.rcsb.org/download/"+self.pdbid.upper()+".pdb")
-            response.raise_for_status()
-            self.pdbfile = response.text.splitlines()
-            with open(self.pdbid+".pdb","w") as fh:
-                for line in self.pdbfile:
-                    fh.write(line+"\n")
-            del(response)
+            self.pdbfile = fetch(pdbid=self.pdbid,fileformat=self.fileformat)
             
-        # Download file from AlphaFold Database
+        # Download file from AlphaFold Database (or take it from the cache)
         elif self.uniprotid is not None:
             print("\t Downloading file from the AlphaFold Protein Structure Database")
-            response = requests.get("https://alphafold.ebi.ac.uk/files/AF-"+self.uniprotid.upper()+"-F1-model_v4.pdb")
-            response.raise_for_status()
-            self.pdbfile = response.text.splitlines()
-            with open(self.uniprotid+".pdb","w") as fh:
-                for line in self.pdbfile:
-                    fh.write(line+"\n")
+            self.pdbfile = fetch(uniprotid=self.uniprotid,fileformat=self.fileformat)
         
         # Read local file
         elif self.filename is not None:
-            print("\t Reading local PDB file")
-            with open(self.filename,'r') as fh:
-                self.pdbfile = fh.readlines()
+            print("\t Reading local {} file".format(self.fileformat.upper()))
+            with open(self.filename,'rb') as fh:
+                self.pdbfile = fh.read()
 
         # Process PDB file
-        if self.pdbfile is not None:
+        if (self.pdbfile is not None) and (self.fileformat == "pdb"):
             digestpdb(self,interactive,delwat,delhet)
 
+        # Process mmCIF or BinaryCIF file
+        elif self.pdbfile is not None:
+            digestcif(self,interactive,delwat,delhet)
+
         # Initialize a dummy chain
         else:
             self.chains = [Chain("A")]
             self.chains[0].residues = []
-            self.chains[0].natoms = 0
-            self.chains[0].nresidues = 0
+            self.chains[0]._protein = self
 
         return
 
 
-    def write_pdb(self,pdbfile):
-        writepdb(self,pdbfile)
+    def __getstate__(self):
+        # The atom store is rebuilt on demand
+        state = self.__dict__.copy()
+        state["_atoms"] = None
+        state["_index"] = None
+        state["_journal"] = []
+        return state
+
 
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.adopt()
+        return
 
-    def update(self):
-        self.nresidues = 0
-        self.natoms = 0
-        self.nchains = len(self.chains)
+
+    def clone(self):
+        """
+        Copy of the Protein that shares its atom arrays with this one
+        (copy-on-write). Until either Protein modifies its atoms, which
+        copies the arrays, they are handed out read-only.
+        """
+        atoms = self.atoms
+        atoms.share()
+        protein = Protein.__new__(Protein)
+        protein.__dict__.update(self.__dict__)
+        protein.ssbonds = None if self.ssbonds is None else [list(ssbond) for ssbond in self.ssbonds]
+        protein._index = None
+        protein._journal = []
+
+        chains = []
         for chain in self.chains:
-            natoms = 0
-            for ires,residue in enumerate(chain.residues):
-                residue.resid = ires+1
-                natoms += residue.natoms
-            chain.natoms = natoms
-            chain.nresidues = len(chain.residues)
-            self.nresidues += chain.nresidues
-            self.natoms += natoms
+            _chain = Chain.__new__(Chain)
+            _chain.__dict__.update(chain.__dict__)
+            _chain._protein = protein
+            _chain.residues = [residue._clone(protein) for residue in chain.residues]
+            chains.append(_chain)
+        protein.chains = chains
+        protein._atoms = atoms.clone(protein)
+        return protein
+
+
+    def adopt(self):
+        """
+        Make this Protein the owner of all its chains and residues
+        """
+        for chain in self.chains:
+            chain._protein = self
+            for residue in chain.residues:
+                residue._protein = self
+        return
+
+
+    @property
+    def atoms(self):
+        """
+        Contiguous atom store of the Protein. It is rebuilt
+        lazily after the Protein topology changes.
+        """
+        if (self._atoms is None) or not self._atoms.matches(self) or not self._atoms.refresh():
+            self._atoms = AtomStore(self)
+        return self._atoms
+
+
+    @property
+    def nchains(self):
+        return 0 if self.chains is None else len(self.chains)
+
+
+    @property
+    def nresidues(self):
+        return 0 if self.chains is None else sum(len(chain.residues) for chain in self.chains)
+
+
+    @property
+    def natoms(self):
+        return 0 if self.chains is None else self.atoms.natoms
+
+
+    @property
+    def coordinates(self):
+        return self.atoms.coordinates
+
+
+    def write_pdb(self,pdbfile,compress=None):
+        writepdb(self,pdbfile,compress)
+
+
+    def save_snapshot(self,filename):
+        """
+        Save the Protein into a binary snapshot file
+        """
+        savesnapshot(self,filename)
+        return
+
+
+    @staticmethod
+    def load_snapshot(filename,mmap=True):
+        """
+        Load a Protein from a binary snapshot file. Coordinates
+        are memory mapped from the file unless mmap is False.
+        """
+        return loadsnapshot(filename,mmap)
+
+
+    def update(self,chain=None,start=0):
+        """
+        Renumber the residues after the chains were modified. If a chain
+        is given, only its residues from position start onwards are
+        renumbered and the atom store is kept, otherwise the store is
+        rebuilt the next time it is needed. Atom and residue counts are
+        always computed on demand.
+        """
+        if chain is None:
+            self._atoms = None
+            chains = self.chains
+        else:
+            chains = [chain]
+        for _chain in chains:
+            residues = _chain.residues
+            for ires in range(start,len(residues)):
+                residues[ires].resid = ires+1
         return
 
 
     def delwaters(self):
-        waters = []
         for chain in self.chains:
+            waters = []
             for ires,residue in enumerate(chain.residues):
                 if residue.name in ['HOH','WAT']:
                     waters.append(ires)
@@ -107,45 +261,25 @@ class Protein:
         return
 
 
-    @staticmethod
-    def addres(residues,residue,natoms,names,elements,coordinates,chain,backbone):
-        _residue = Residue(residue,natoms)
-        _residue.names = np.array(names)
-        _residue.elements = np.array(elements)
-        _residue.coordinates = np.array(coordinates)
-        _residue.chain = chain
-        _residue.backbone = backbone
-        _residue.resid = len(residues) + 1
-        residues.append(_residue)
+    def mutate(self,original,new,cache=None):
+        point_mutation(self,original,new,cache)
         return
 
 
-    @staticmethod
-    def addchain(chains,chain,residues,natoms,resid,nmissing):
-        _chain = Chain(chain)
-        _chain.residues = copy.deepcopy(residues)
-        _chain.natoms = natoms
-        _chain.nresidues = resid
-        chains.append(_chain)
-        return [], 0 ,0 ,0
-
-
-    def savessbond(self,ssbonds,residue,resid,nmissing,chain):
-        if (self.nssbonds > 0) and (residue in ['CYS','CYX']):
-            for issbond in range(self.nssbonds):
-                if ((resid+nmissing == ssbonds[issbond][0]) and (chain == ssbonds[issbond][1])):
-                        residue = 'CYX'
-                        self.ssbonds[issbond][0] = resid
-                        self.ssbonds[issbond][1] = chain
-                elif ((resid+nmissing == ssbonds[issbond][2]) and (chain == ssbonds[issbond][3])):
-                        residue = 'CYX'
-                        self.ssbonds[issbond][2] = resid
-                        self.ssbonds[issbond][3] = chain
-        return residue
-
-
-    def mutate(self,original,new):
-        point_mutation(self,original,new)
+    def mutate_many(self,mutations):
+        """
+        Perform a list of (residue, new) point mutations at once
+        """
+        point_mutations(self,mutations)
+        return
+
+
+    def saturation_mutagenesis(self,positions,output,workers=None,pdbdir=None,cachedir=None):
+        """
+        Scan all 19 substitutions at each of positions in parallel,
+        writing the results to the CSV table output
+        """
+        saturation_mutagenesis(self,positions,output,workers,pdbdir,cachedir=cachedir)
         return
 
 
@@ -167,20 +301,21 @@ class Protein:
             else:
                 raise MyDockingError()
 
-        for _chain in self.chains:
-            if _chain.name == chain:
-                newcoords = appendc(_chain,_residue,psi)
-                natoms = len(_residue.coordinates)
-                newres = Residue(residue,natoms)
-                newres.names = _residue.elements[:,1]
-                newres.coordinates = newcoords
-                newres.elements = _residue.elements[:,0]
-                newres.chain = chain
-                newres.backbone = _residue.backbone
-                newres.resid = len(_chain.residues) + 1
-                _chain.residues.append(newres)
-                break
-        self.update()
+        _chain = self.getchain(chain)
+        newcoords = appendc(_chain,_residue,psi)
+        natoms = len(_residue.coordinates)
+        newres = Residue(residue,natoms)
+        newres.names = _residue.elements[:,1]
+        newres.coordinates = newcoords
+        newres.elements = _residue.elements[:,0]
+        newres.chain = chain
+        newres.backbone = _residue.backbone
+        newres.resid = len(_chain.residues) + 1
+        _chain.residues.append(newres)
+        if self._journal: self._journal[-1].insert(_chain,newres)
+        self._indexresidue(newres)
+        self._insertresidue(_chain,len(_chain.residues)-1,newres)
+        self.update(_chain,len(_chain.residues)-1)
         find_clashes_residue(newres,[self])
         return
 
@@ -202,47 +337,186 @@ class Protein:
             else:
                 raise MyDockingError()
 
-        for _chain in self.chains:
-            if _chain.name == chain:
-                newcoords = prependn(_chain,_residue,phi)
-                natoms = len(_residue.coordinates)
-                newres = Residue(residue,natoms)
-                newres.names = _residue.elements[:,1]
-                newres.coordinates = newcoords
-                newres.elements = _residue.elements[:,0]
-                newres.chain = chain
-                newres.backbone = _residue.backbone
-                newres.resid = len(_chain.residues) + 1
-                _chain.residues.insert(0,newres)
-                break
-        self.update()
+        _chain = self.getchain(chain)
+        newcoords = prependn(_chain,_residue,phi)
+        natoms = len(_residue.coordinates)
+        newres = Residue(residue,natoms)
+        newres.names = _residue.elements[:,1]
+        newres.coordinates = newcoords
+        newres.elements = _residue.elements[:,0]
+        newres.chain = chain
+        newres.backbone = _residue.backbone
+        newres.resid = len(_chain.residues) + 1
+        _chain.residues.insert(0,newres)
+        if self._journal: self._journal[-1].insert(_chain,newres)
+        self._indexresidue(newres)
+        self._insertresidue(_chain,0,newres)
+        self.update(_chain)
         find_clashes_residue(newres,[self])
         return
 
 
     def delchain(self,chain):
+        if self._journal: self._journal[-1].chains()
         newchains = []
         for i, _chain in enumerate(self.chains):
-            if _chain.name == chain: continue
+            if _chain.name == chain:
+                if self._index is not None: self._index.removechain(_chain,self)
+                continue
             newchains.append(_chain)
         self.chains = newchains
+        if self._index is not None: self._index.sync(self)
         self.update()
         return
 
 
     def findresidue(self,name):
-        for _chain in self.chains:
-            for residue in _chain.residues:
-                if residue.name == name:
-                    print("{}:{}{}".format(_chain.name,name,residue.resid))
+        for residue in self.resindex.names.get(name,[]):
+            print("{}:{}{}".format(residue.chain,name,residue.resid))
+        return
+
+
+    @property
+    def resindex(self):
+        """
+        Residue and chain lookup tables, rebuilt lazily if the
+        chains were modified without updating them
+        """
+        if (self._index is None) or not self._index.matches(self):
+            self._index = ResidueIndex(self)
+        return self._index
+
+
+    def _indexresidue(self,residue):
+        # Add a new residue to the lookup tables
+        residue._protein = self
+        if self._index is not None:
+            self._index.add(residue)
+            self._index.sync(self)
+        return
+
+
+    def _insertresidue(self,chain,position,residue):
+        # Splice a new residue into the atom store, if there is one
+        if (self._atoms is not None) and self._atoms.has_chain(chain):
+            atoms = self._atoms
+            if atoms.refresh():
+                atoms.insert(chain,position,residue)
+            else:
+                self._atoms = None
+        return
+
+
+    def _removeresidue(self,chain,residue):
+        # Take a residue out of a chain, the atom store and the lookup tables
+        residues = chain.residues
+        if residues[-1] is residue:
+            position = len(residues) - 1
+        else:
+            position = [ires for ires,other in enumerate(residues) if other is residue][0]
+        if (self._atoms is not None) and self._atoms.has_chain(chain):
+            if self._atoms.refresh():
+                self._atoms.remove(chain,position)
+            else:
+                self._atoms = None
+        del residues[position]
+        if self._index is not None:
+            self._index.remove(residue)
+            self._index.sync(self)
+        self.update(chain,position)
+        return
+
+
+    def transaction(self):
+        """
+        Start a transaction. The changes made by mutations, PTMs, append,
+        prepend and delchain can then be undone with rollback() or kept
+        with commit(). As a context manager, the transaction is committed
+        at the end of the block, or rolled back if an error is raised.
+        """
+        transaction = Transaction(self)
+        self._journal.append(transaction)
+        return transaction
+
+
+    def commit(self):
+        """
+        Keep the changes of the innermost open transaction and close it
+        """
+        if len(self._journal) == 0:
+            raise MyDockingError("There is no open transaction")
+        transaction = self._journal.pop()
+        if len(self._journal) > 0:
+            self._journal[-1].merge(transaction)
+        return
+
+
+    def rollback(self):
+        """
+        Undo the changes of the innermost open transaction, which
+        remains open for further changes
+        """
+        if len(self._journal) == 0:
+            raise MyDockingError("There is no open transaction")
+        journal, self._journal = self._journal, []
+        try:
+            journal[-1].undo()
+        finally:
+            self._journal = journal
         return
 
 
-    def modify(self,original,modification):
-        post_translational_modification(self,original,modification)
+    def getchain(self,chain):
+        """
+        Chain instance with a given name
+        """
+        _chain = self.resindex.chains.get(chain)
+        if _chain is None:
+            raise MyDockingError("There is no chain '{}' in protein".format(chain))
+        return _chain
+
+
+    def getresidue(self,chain,resnum,icode=""):
+        """
+        Residue with a given author residue number and insertion
+        code in a chain, as read from the structure file
+        """
+        _residue = self.resindex.numbers.get((chain,resnum,icode))
+        if _residue is None:
+            raise MyDockingError("There is no residue '{}:{}{}' in protein".format(chain,resnum,icode))
+        return _residue
+
+
+    def modify(self,original,modification,hissite="ask",cache=None):
+        post_translational_modification(self,original,modification,hissite,cache)
         return
 
 
+    def modify_many(self,modifications,hissite="ask"):
+        """
+        Apply a list of (residue, modification) PTMs at once
+        """
+        post_translational_modifications(self,modifications,hissite)
+        return
+
+
+    def ptm_scan(self,output,ptms=None,minconfidence=None,maxneighbors=None,workers=None,pdbdir=None,hissite="clashes",cachedir=None):
+        """
+        Generate every compatible modified variant in parallel,
+        writing the results to the CSV table output
+        """
+        ptm_scan(self,output,ptms,minconfidence,maxneighbors,workers=workers,pdbdir=pdbdir,hissite=hissite,cachedir=cachedir)
+        return
+
+
+    def ptm_combinations(self,sites,hissite="clashes"):
+        """
+        Combinations of the (residue, modification) PTMs in sites
+        that do not clash with each other, see PTMCombinations
+        """
+        return PTMCombinations(self,sites,hissite)
+
+
     def dock(self,ligand,receptor,boxcenter=None,boxsize=10,output=None,flexible=None):
         dock_ligand(self,ligand,receptor,boxcenter,boxsize,output,flexible)
         return
@@ -286,8 +560,9 @@ class Protein:
             except:
                 pass
 
-        with open(_pdb,"r") as fh:
-            self.pdbfile = fh.readlines()
+        with open(_pdb,"rb") as fh:
+            self.pdbfile = fh.read()
+        self.fileformat = "pdb"
         digestpdb(self,interactive=False,delwat=False,delhet=False)
 
         return
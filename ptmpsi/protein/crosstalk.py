@@ -0,0 +1,96 @@
+import io
+import contextlib
+from ptmpsi.math import find_clashes_residue
+from ptmpsi.math.rotamers import count_clashes_residues
+from ptmpsi.protein.mutate import post_translational_modification
+from ptmpsi.protein.tools import get_residue
+from ptmpsi.protein.placement import assign, detach
+from ptmpsi.exceptions import MyDockingError
+
+
+class PTMCombinations:
+    """
+    Combinations of PTMs over a set of sites, given as (residue, ptm)
+    pairs (a residue may appear with several PTMs). Every PTM is placed
+    once on its own, on a copy-on-write clone of the Protein, and the
+    placements are kept. Two placements are compatible if they are on
+    different residues and do not clash with each other, and only the
+    combinations in which all pairs are compatible are enumerated.
+    Proteins with a combination are assembled from the kept placements.
+    """
+    def __init__(self,protein,sites,hissite="clashes"):
+        self.protein = protein
+        self.placements = {}
+        self.clashes = {}
+        self.failed = {}
+
+        # Single-site placements, keyed by (chain, resid, ptm)
+        for original,ptm in sites:
+            residue = get_residue(protein,original)
+            key = (residue.chain,residue.resid,ptm.lower())
+            if (key in self.placements) or (key in self.failed): continue
+            if key[2] == "alpha-acetylation":
+                self.failed[key] = "N-terminal acetylation adds a residue and cannot be combined"
+                continue
+            clone = protein.clone()
+            _residue = clone.getchain(key[0]).residues[key[1]-1]
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    post_translational_modification(clone,_residue,ptm,hissite)
+                    self.clashes[key] = find_clashes_residue(_residue,[clone],printing=False)
+            except MyDockingError as error:
+                self.failed[key] = " ".join(str(error).split())
+                continue
+            self.placements[key] = detach(_residue)
+        self.keys = sorted(self.placements)
+        print("\t Placed {} single-site modifications ({} failed)".format(len(self.keys),len(self.failed)))
+
+        # Pairwise compatibility graph
+        self.compatible = { key: set() for key in self.keys }
+        npairs = 0
+        for i,ikey in enumerate(self.keys):
+            iresidue = self.placements[ikey]
+            for jkey in self.keys[i+1:]:
+                if ikey[:2] == jkey[:2]: continue
+                npairs += 1
+                jresidue = self.placements[jkey]
+                if count_clashes_residues(iresidue,iresidue.coordinates[None],[jresidue])[0] == 0:
+                    self.compatible[ikey].add(jkey)
+                    self.compatible[jkey].add(ikey)
+        ncompatible = sum(len(value) for value in self.compatible.values())//2
+        print("\t {} out of {} pairs of modifications are compatible".format(ncompatible,npairs))
+        return
+
+
+    def combinations(self,minsize=1,maxsize=None):
+        """
+        Generate all the combinations (tuples of keys) of pairwise
+        compatible placements with between minsize and maxsize PTMs
+        """
+        if maxsize is None: maxsize = len(self.keys)
+
+        def extend(combination,candidates):
+            if len(combination) >= minsize:
+                yield tuple(combination)
+            if len(combination) == maxsize: return
+            for i,key in enumerate(candidates):
+                # Candidates after key that are compatible with all so far
+                remaining = [ other for other in candidates[i+1:] if other in self.compatible[key] ]
+                yield from extend(combination+[key],remaining)
+
+        yield from extend([],self.keys)
+
+
+    def build(self,combination):
+        """
+        Clone of the Protein with the placements of a combination
+        """
+        for ikey in combination:
+            for jkey in combination:
+                if (ikey < jkey) and (jkey not in self.compatible[ikey]):
+                    raise MyDockingError("Modifications {} and {} are not compatible".format(ikey,jkey))
+        protein = self.protein.clone()
+        for key in combination:
+            assign(protein.getchain(key[0]).residues[key[1]-1],self.placements[key])
+        return protein
+
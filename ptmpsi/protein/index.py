@@ -0,0 +1,88 @@
+class ResidueIndex:
+    """
+    Lookup tables of a Protein: chains by name, residues by author
+    number (chain, resnum, insertion code) and residues by name. The
+    tables are updated incrementally as residues are added, removed or
+    renamed, and rebuilt when the chains are changed behind its back.
+    """
+    def __init__(self,protein):
+        self.chains  = {}
+        self.numbers = {}
+        self.names   = {}
+        for chain in protein.chains:
+            self.chains.setdefault(chain.name,chain)
+            for residue in chain.residues:
+                residue._protein = protein
+                self.add(residue)
+        self.signature = self._signature(protein)
+        return
+
+
+    @staticmethod
+    def _signature(protein):
+        return [ (id(chain),len(chain.residues)) for chain in protein.chains ]
+
+
+    def sync(self,protein):
+        """
+        Record the current chains after an incremental update
+        """
+        self.signature = self._signature(protein)
+        return
+
+
+    def matches(self,protein):
+        """
+        Check that no chains or residues were added or removed
+        without going through the index
+        """
+        return self.signature == self._signature(protein)
+
+
+    @staticmethod
+    def _number(residue):
+        # Only residues read from a file have an author number
+        resnum = getattr(residue,"resnum",None)
+        if resnum is None: return None
+        return (residue.chain,resnum,getattr(residue,"icode",""))
+
+
+    def add(self,residue):
+        key = self._number(residue)
+        if key is not None:
+            self.numbers.setdefault(key,residue)
+        self.names.setdefault(residue.name,[]).append(residue)
+        return
+
+
+    def remove(self,residue):
+        key = self._number(residue)
+        if (key is not None) and (self.numbers.get(key) is residue):
+            del self.numbers[key]
+        self.names[residue.name] = [ other for other in self.names.get(residue.name,[]) if other is not residue ]
+        return
+
+
+    def rename(self,residue,old):
+        self.names[old] = [ other for other in self.names.get(old,[]) if other is not residue ]
+        self.names.setdefault(residue.name,[]).append(residue)
+        return
+
+
+    def addchain(self,chain):
+        self.chains.setdefault(chain.name,chain)
+        for residue in chain.residues:
+            self.add(residue)
+        return
+
+
+    def removechain(self,chain,protein):
+        for residue in chain.residues:
+            self.remove(residue)
+        if self.chains.get(chain.name) is chain:
+            del self.chains[chain.name]
+            for other in protein.chains:
+                if (other is not chain) and (other.name == chain.name):
+                    self.chains[chain.name] = other
+                    break
+        return
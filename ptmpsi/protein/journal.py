@@ -0,0 +1,100 @@
+import numpy as np
+
+# Residue attributes that are restored by other means
+_SKIP = ["_protein", "_view", "_shared", "_lookup", "_torsions", "_name",
+         "_coordinates", "_names", "_elements"]
+
+
+class Transaction:
+    """
+    Undo log of the changes made to a Protein. Residues save their
+    state the first time they are modified within the transaction,
+    and residue insertions and chain deletions are recorded as they
+    happen, so a rollback only touches what changed.
+    """
+    def __init__(self,protein):
+        self.protein = protein
+        self.records = []
+        self.saved = set()
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self,kind,value,traceback):
+        if self in self.protein._journal:
+            if kind is None:
+                self.protein.commit()
+            else:
+                self.protein.rollback()
+                self.protein.commit()
+        return False
+
+
+    def save(self,residue):
+        """
+        Record the state of a residue before it is modified
+        """
+        if id(residue) in self.saved: return
+        self.saved.add(id(residue))
+        state = { key: value for key,value in residue.__dict__.items() if key not in _SKIP }
+        if "backbone" in state: state["backbone"] = np.array(state["backbone"])
+        arrays = (np.array(residue._coordinates), np.array(residue._names), np.array(residue._elements))
+        self.records.append(("residue",residue,(residue.name,arrays,state)))
+        return
+
+
+    def insert(self,chain,residue):
+        """
+        Record a residue added to a chain
+        """
+        self.records.append(("insert",chain,residue))
+        return
+
+
+    def chains(self):
+        """
+        Record the list of chains before it is modified
+        """
+        self.records.append(("chains",None,list(self.protein.chains)))
+        return
+
+
+    def merge(self,other):
+        """
+        Take over the records of a committed inner transaction
+        """
+        self.records += other.records
+        self.saved |= other.saved
+        return
+
+
+    def undo(self):
+        """
+        Undo all the records, most recent first
+        """
+        protein = self.protein
+        for kind,target,data in reversed(self.records):
+            if kind == "residue":
+                name, arrays, state = data
+                # Attributes added during the transaction are dropped
+                for key in [ key for key in target.__dict__ if (key not in state) and (key not in _SKIP) ]:
+                    del target.__dict__[key]
+                target.__dict__.update(state)
+                target._coordinates, target._names, target._elements = arrays
+                target._lookup = None
+                target._torsions = None
+                target._shared = False
+                target._replaced()
+                target.name = name
+            elif kind == "insert":
+                protein._removeresidue(target,data)
+            elif kind == "chains":
+                protein.chains = data
+                protein._index = None
+                protein.update()
+        self.records = []
+        self.saved = set()
+        return
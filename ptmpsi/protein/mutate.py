@@ -1,62 +1,84 @@
 import numpy as np
-from copy import deepcopy as copy
 from ptmpsi.math import alignres, rotate_chi1, rotate_chi2, find_clashes_residue, nerf, rotmatvec
+from ptmpsi.math.neighbors import NeighborIndex
+from ptmpsi.math.rotamers import chi_rotamers, internal_overlaps, count_clashes
 from ptmpsi.residues import Residue, resdict, ptmdict, ptm2nonstandard
 from ptmpsi.residues.ptms import doptm, check_ptm, get_ptm_name, add_hydrogens
 from ptmpsi.residues.template import Template
 from ptmpsi.exceptions import MyDockingError
 from ptmpsi.constants import nhbond, amidebond
 from ptmpsi.protein.tools import get_residue, get_template
+from ptmpsi.protein.placement import mutationkey, modificationkey, assign
+from ptmpsi.protein.packing import pack
 
 _CYSPTMS = ["carbamoylation", "sulfhydration","sulfenylation","sulfinylation","sulfonylation","nitrosylation","glutathionylation", "cysteinylation"]
 
-def point_mutation(protein,original,new):
+def place_mutation(protein,original,new):
     """
-    Perform a point mutation.
+    Replace a residue by a template aligned on its backbone,
+    without looking for clashes. Returns the Residue and the
+    Template instances.
     """
     # Get Residue and Template instances
     _original = get_residue(protein,original) 
     _new = get_template(new)
+    _original._checkpoint()
 
     # Get new coordinates
     newcoords = alignres(_original,_new)
 
-    # Update residue fields
-    oldatoms = copy(_original.natoms)
-    _original.coordinates = copy(newcoords)
-    _original.names = copy(_new.elements[:,1])
-    _original.elements = copy(_new.elements[:,0])
-    _original.backbone = copy(_new.backbone)
-    _original.chi1 = copy(_new.chi1)
-    _original.chi2 = copy(_new.chi2)
-    _original.cattach = copy(_new.cattach)
-    _original.nattach = copy(_new.nattach)
+    # Update residue fields, the atom store of the protein
+    # splices the new atoms in when it is next accessed
+    # newcoords is a new array, only the template arrays are copied
+    _original.coordinates = newcoords
+    _original.names = np.array(_new.elements[:,1])
+    _original.elements = np.array(_new.elements[:,0])
+    _original.backbone = np.array(_new.backbone)
+    _original.chi1 = _new.chi1
+    _original.chi2 = _new.chi2
+    _original.cattach = _new.cattach
+    _original.nattach = _new.nattach
     _original.natoms = len(newcoords)
     _original.name = _new.name
 
-    # Fix amide hydrogen position
-    if _original.resid > 1:
-        for chain in protein.chains:
-            if chain.name == _original.chain:
-                previous = chain.residues[_original.resid-2]
-                h = nerf(previous.find_coord("O"),
-                         previous.find_coord("C"),
-                         _original.find_coord("N"),
-                         nhbond, 120, 180)
-                _original.coordinates[_original.find("H")] = copy(h)
-        newcoords = copy(_original.coordinates)
-
-    # Update protein
-    if oldatoms != _original.natoms:
-        protein.update()
+    # Fix amide hydrogen position (PRO has none)
+    if (_original.resid > 1) and ("H" in _original.names):
+        previous = protein.getchain(_original.chain).residues[_original.resid-2]
+        h = nerf(previous.find_coord("O"),
+                 previous.find_coord("C"),
+                 _original.find_coord("N"),
+                 nhbond, 120, 180)
+        _original._unshare()
+        _original.coordinates[_original.find("H")] = h
+
+    return _original, _new
+
+
+def point_mutation(protein,original,new,cache=None):
+    """
+    Perform a point mutation. If a PlacementCache is given, the final
+    residue is looked up there before placing it, and stored after.
+    """
+    if cache is not None:
+        _original = get_residue(protein,original)
+        key = mutationkey(cache,protein,_original,get_template(new))
+        placed = cache.get(key)
+        if placed is not None:
+            assign(_original,placed)
+            print("\n\t Using cached side-chain placement")
+            return
+
+    _original, _new = place_mutation(protein,original,new)
+    newcoords = np.array(_original.coordinates)
 
     # Find possible clashes
     found = True
-    nclashes = find_clashes_residue(_original,[protein],printing=False)
+    index = NeighborIndex([protein])
+    nclashes = find_clashes_residue(_original,[protein],printing=False,index=index)
 
     # Scan chi1 and chi2 dihedrals for a better rotamer
     if nclashes > 0:
-        found, angle1, angle2, minclashes = scan_chi1_chi2(protein,_original,nclashes,_new.chi1,_new.chi2)
+        found, angle1, angle2, minclashes = scan_chi1_chi2(protein,_original,nclashes,_new.chi1,_new.chi2,index)
 
     # Get final rotamer
     if found:
@@ -64,29 +86,43 @@ def point_mutation(protein,original,new):
     else:
         print("\n\t\t Warning: All rotamers had clashes!")
         print("\t\t          using rotamer with {} clashes".format(minclashes))
-        _original.coordinates = copy(newcoords)
+        _original.coordinates = newcoords
         if angle1 > 0: rotate_chi1(_original,_new.chi1,angle1)
         if angle2 > 0: rotate_chi2(_original,_new.chi2,angle2)
 
+    if cache is not None: cache.put(key,_original)
+    return
 
 
-            
+def point_mutations(protein,mutations):
+    """
+    Perform several point mutations, given as (residue, new) pairs,
+    at once. See place_many for how the side chains are placed.
+    """
+    sites = unique_sites(protein,mutations)
+    placed = []
+    for _original,new in sites:
+        _original, _new = place_mutation(protein,_original,new)
+        placed.append((_original,_new.chi1,_new.chi2,None))
+    place_many(protein,placed)
     return
 
 
-def post_translational_modification(protein,original,ptm):
+def ptm_route(protein,_original,ptm):
+    """
+    Check that a PTM can be applied to a residue. Returns "prepend"
+    for N-terminal acetylation, the name of the nonstandard residue
+    for PTMs coded as residues, or None if a radical is attached.
+    """
     _ptm = ptm.lower()
-    _original = get_residue(protein,original)
 
     # Check if residue is either C- or N-terminus
-    for chain in protein.chains:
-        if chain.name == _original.chain:
-            nterminus = _original == chain.residues[0]
-            cterminus = _original == chain.residues[-1]
-            # Check for N-terminal acetylation case
-            if nterminus and (ptm == "alpha-acetylation"):
-                protein.prepend(_original.chain,"ACE")
-                return
+    chain = protein.getchain(_original.chain)
+    nterminus = _original == chain.residues[0]
+    cterminus = _original == chain.residues[-1]
+    # Check for N-terminal acetylation case
+    if nterminus and (ptm == "alpha-acetylation"):
+        return "prepend"
 
     # Get radical to be attached
     _radical = ptmdict.get(_ptm,0)
@@ -96,22 +132,31 @@ def post_translational_modification(protein,original,ptm):
     # Special case for Cystein PTMs
     if _original.name in ["CYS", "CYS", "CYM"]:
         new = ptm2nonstandard.get(_ptm,None)
-        print(ptm,new)
         if new is not None:
-            point_mutation(protein,_original,new)
-            return
+            return new
     elif _ptm in _CYSPTMS:
         raise MyDockingError("Post-translational modification '{}' is only coded for CYS-type residues".format(_ptm))
 
-    # TODO:
+    # Known PTM without a radical yet
     if _radical is None:
-        raise MyDockingError("TODO")
+        raise MyDockingError("The radical of post-translational modification '{}' is not coded yet".format(_ptm))
+
+    return None
+
+
+def place_modification(_original,ptm,hissite="ask"):
+    """
+    Attach the radical of a PTM to a residue, without looking for clashes.
+    hissite is the policy to choose the reacting histidine nitrogen.
+    """
+    _ptm = ptm.lower()
+    _radical = ptmdict[_ptm]
 
     # Check if PTM is compatible with residue and get geometrical parameters
     bond, angle, dihedral = check_ptm(_original.name,_ptm)
 
     # Perform PTM
-    doptm(_original,_radical,bond,angle,dihedral)
+    doptm(_original,_radical,bond,angle,dihedral,hissite=hissite)
     if _ptm == 'dimethylation': 
         if _original.name in ["LYS","LYN"]:
             doptm(_original,_radical,bond,109,150)
@@ -128,39 +173,61 @@ def post_translational_modification(protein,original,ptm):
     # Add missing hydrogens
     if _original.name  in ["ARG","LYS","LYN"]:
         add_hydrogens(_original,_ptm)
+    return
+
+
+def ptm_chis(_original):
+    """
+    Side-chain dihedrals of a modified residue, taken from the
+    template of the unmodified one
+    """
+    _template = resdict[_original.name]
+    if _template.chi1 is None:
+        chi1 = None
+    else:
+        chi1 = _original.find_many(_template.elements[_template.chi1,1])
 
-    newcoords = copy(_original.coordinates)
+    if _template.chi2 is None:
+        chi2 = None
+    else:
+        chi2 = _original.find_many(_template.elements[_template.chi2,1])
+    return chi1, chi2
+
+
+def post_translational_modification(protein,original,ptm,hissite="ask",cache=None):
+    _ptm = ptm.lower()
+    _original = get_residue(protein,original)
+
+    route = ptm_route(protein,_original,ptm)
+    if route == "prepend":
+        protein.prepend(_original.chain,"ACE")
+        return
+    elif route is not None:
+        point_mutation(protein,_original,route,cache)
+        return
+
+    # Interactive histidine choices are not cached
+    if (_original.name in ["HIS","HIP","HID","HIE"]) and (str(hissite).lower() == "ask"): cache = None
+    if cache is not None:
+        key = modificationkey(cache,protein,_original,_ptm,ptmdict[_ptm],hissite)
+        placed = cache.get(key)
+        if placed is not None:
+            assign(_original,placed)
+            print("\n\t Using cached side-chain placement")
+            return
 
-    # Update protein
-    protein.update()
+    place_modification(_original,_ptm,hissite)
+    newcoords = np.array(_original.coordinates)
 
     # Find possible clashes
     found = True
-    nclashes = find_clashes_residue(_original,[protein])
+    index = NeighborIndex([protein])
+    nclashes = find_clashes_residue(_original,[protein],index=index)
 
     # Scan chi1 and chi2 dihedrals for a better rotamer
     if nclashes > 0:
-        _template = resdict[_original.name]
-        if _template.chi1 is None:
-            chi1 = None
-        else:
-            chi1 = np.array([
-                _original.find(_template.elements[_template.chi1[0],1]),
-                _original.find(_template.elements[_template.chi1[1],1]),
-                _original.find(_template.elements[_template.chi1[2],1]),
-                _original.find(_template.elements[_template.chi1[3],1])
-                ])
-
-        if _template.chi2 is None:
-            chi2 = None
-        else:
-            chi2 = np.array([
-                _original.find(_template.elements[_template.chi2[0],1]),
-                _original.find(_template.elements[_template.chi2[1],1]),
-                _original.find(_template.elements[_template.chi2[2],1]),
-                _original.find(_template.elements[_template.chi2[3],1])
-                ])
-        found, angle1, angle2, minclashes = scan_chi1_chi2(protein,_original,nclashes,chi1,chi2)
+        chi1, chi2 = ptm_chis(_original)
+        found, angle1, angle2, minclashes = scan_chi1_chi2(protein,_original,nclashes,chi1,chi2,index)
 
     # Get final rotamer
     if found:
@@ -168,43 +235,106 @@ def post_translational_modification(protein,original,ptm):
     else:
         print("\n\t\t Warning: All rotamers had clashes!")
         print("\t\t          using rotamer with {} clashes".format(minclashes))
-        _original.coordinates = copy(newcoords)
+        _original.coordinates = newcoords
         if angle1 > 0: rotate_chi1(_original,chi1,angle1)
         if angle2 > 0: rotate_chi2(_original,chi2,angle2)
 
     # Update residue name
     _original.name = get_ptm_name(_original.name, _ptm)
 
+    if cache is not None: cache.put(key,_original)
+    return
+
+
+def post_translational_modifications(protein,modifications,hissite="ask"):
+    """
+    Apply several PTMs, given as (residue, ptm) pairs, at once.
+    See place_many for how the side chains are placed.
+    """
+    sites = unique_sites(protein,modifications)
+    placed = []
+    for _original,ptm in sites:
+        _ptm = ptm.lower()
+        route = ptm_route(protein,_original,ptm)
+        if route == "prepend":
+            protein.prepend(_original.chain,"ACE")
+        elif route is not None:
+            _original, _new = place_mutation(protein,_original,route)
+            placed.append((_original,_new.chi1,_new.chi2,None))
+        else:
+            place_modification(_original,_ptm,hissite)
+            chi1, chi2 = ptm_chis(_original)
+            placed.append((_original,chi1,chi2,get_ptm_name(_original.name,_ptm)))
+    place_many(protein,placed)
+    return
+
+
+def unique_sites(protein,edits):
+    """
+    Residue instances of a list of (residue, change) pairs. All residues
+    are found before anything changes, and each one may appear only once.
+    """
+    sites = [ (get_residue(protein,original),change) for original,change in edits ]
+    seen = set()
+    for _original,change in sites:
+        if id(_original) in seen:
+            raise MyDockingError("Residue '{}:{}{}' appears more than once".format(_original.chain,_original.name,_original.resid))
+        seen.add(id(_original))
+    return sites
+
+
+def place_many(protein,placed):
+    """
+    Fix the side chains of several residues already placed in the
+    protein, given as (residue, chi1, chi2, newname) tuples. Their
+    rotamers are chosen jointly (see ptmpsi.protein.packing.pack)
+    against a single neighbor index of the protein, and residues are
+    renamed to newname (if not None) at the end.
+    """
+    if len(placed) == 0: return
+    nclashes = pack(protein,[ entry[:3] for entry in placed ])
+    for (_original, chi1, chi2, name), clashes in zip(placed,nclashes):
+        print("\n\t Placed side chain of {}:{}{}".format(_original.chain,_original.name,_original.resid))
+        if clashes == 0:
+            print("\t Found rotamer with no clashes!")
+        else:
+            print("\t\t Warning: All rotamers had clashes!")
+            print("\t\t          using rotamer with {} clashes".format(clashes))
+
+    for _original, chi1, chi2, name in placed:
+        if name is not None: _original.name = name
     return
 
 
-def scan_chi1_chi2(protein,residue,nclashes,chi1,chi2):
+def scan_chi1_chi2(protein,residue,nclashes,chi1,chi2,index=None):
     print("\n\t Current rotamer has {} possible clashes".format(nclashes))
     angle1 = 0; angle2 = 0
     minclashes = nclashes
     found = False
 
     # If chi1 info is None, no possible rotamers (GLY, PRO)
-    if (chi1 is not None):
-        rotamers1 = range(0,360,30)
-        rotamers2 = [0] if chi2 is None else range(0,360,30)
-        for irot in rotamers1:
-            if found: break
-            if irot > 0:
-                internal = rotate_chi1(residue,chi1,30)
-            for jrot in rotamers2:
-                if (irot == 0) and (jrot == 0): continue
-                if chi2 is not None:
-                    internal = rotate_chi2(residue,chi2,30)
-                if internal: continue
-                nclashes = find_clashes_residue(residue,[protein],printing=False)
-                if nclashes == 0:
-                    found = True
-                    return found, 0, 0, 0
-                print("\t Current rotamer has {} possible clashes".format(nclashes))
-                if nclashes < minclashes:
-                    minclashes = nclashes
-                    angle1 = irot
-                    angle2 = jrot
+    if (chi1 is None):
+        return found, angle1, angle2, minclashes
+
+    # Generate and score all rotamers at once. Only the residue moves
+    # during the scan, so a single index of the environment serves all.
+    chis = [chi1] if chi2 is None else [chi1, chi2]
+    rotamers, grid = chi_rotamers(residue.coordinates,chis,[residue.moving(chi) for chi in chis])
+    internal = internal_overlaps(rotamers)
+    if index is None: index = NeighborIndex([protein])
+    clashes = count_clashes(residue,rotamers,index)
+
+    # Keep the first rotamer without clashes, in scan order
+    for k in range(1,len(rotamers)):
+        if internal[k]: continue
+        if clashes[k] == 0:
+            residue.coordinates = rotamers[k]
+            found = True
+            return found, 0, 0, 0
+        print("\t Current rotamer has {} possible clashes".format(clashes[k]))
+        if clashes[k] < minclashes:
+            minclashes = clashes[k]
+            angle1 = grid[k,0]
+            angle2 = grid[k,1] if chi2 is not None else 0
 
     return found, angle1, angle2, minclashes
@@ -0,0 +1,214 @@
+import numpy as np
+from ptmpsi.constants import clashheavy
+from ptmpsi.math.neighbors import NeighborIndex, atomflags, clashthreshold
+from ptmpsi.math.rotamers import chi_rotamers, internal_overlaps, count_clashes
+
+
+def pack(protein,placed,index=None,maxnodes=20000):
+    """
+    Choose jointly the rotamers of several residues already placed in
+    the protein, given as (residue, chi1, chi2) tuples, minimizing the
+    total number of clashes. Clashes of every rotamer with the rest of
+    the protein, and between every pair of rotamers of two residues,
+    are computed in tables once. Rotamers that cannot be part of the
+    best assignment are removed by dead-end elimination, and the rest
+    is solved exactly for every group of interacting residues, with a
+    budget of maxnodes search nodes. Returns the clashes of each residue.
+    """
+    residues = [ entry[0] for entry in placed ]
+    if index is None: index = NeighborIndex([protein])
+    position = { id(residue): ires for ires,residue in enumerate(index.residues) }
+    skip = np.isin(index.residue,[position[id(residue)] for residue in residues])
+
+    conformers = [ candidates(residue,chi1,chi2) for residue,chi1,chi2 in placed ]
+    selfs = [ count_clashes(residue,conformer,index,skip) for residue,conformer in zip(residues,conformers) ]
+    pairs = pair_tables(residues,conformers)
+
+    alive = dead_end_elimination(selfs,pairs)
+    ncandidates = sum(len(conformer) for conformer in conformers)
+    print("\n\t Packing {} residues: {} of {} rotamers left after dead-end elimination".format(
+          len(residues),sum(len(a) for a in alive),ncandidates))
+
+    choice = solve(selfs,pairs,alive,maxnodes)
+    for residue,conformer,k in zip(residues,conformers,choice):
+        residue.coordinates = conformer[k]
+
+    nclashes = []
+    for i in range(len(residues)):
+        energy = selfs[i][choice[i]]
+        for j in range(len(residues)):
+            if (i,j) in pairs: energy += pairs[(i,j)][choice[i],choice[j]]
+        nclashes.append(int(energy))
+    return nclashes
+
+
+def candidates(residue,chi1,chi2):
+    """
+    Rotamers of a residue on the chi1/chi2 grid without internal
+    overlaps. The first one is always the current side chain.
+    """
+    if chi1 is None:
+        return residue.coordinates[None]
+    chis = [chi1] if chi2 is None else [chi1, chi2]
+    rotamers, grid = chi_rotamers(residue.coordinates,chis,[residue.moving(chi) for chi in chis])
+    internal = internal_overlaps(rotamers)
+    internal[0] = False
+    return rotamers[~internal]
+
+
+def pair_tables(residues,conformers):
+    """
+    Clashes between every pair of rotamers of every pair of residues
+    that can reach each other. Returns a dictionary with the (Ki,Kj)
+    table of (i,j), also stored transposed under (j,i). Atoms that are
+    the same in all the rotamers of a residue are only counted once.
+    """
+    centers = [ conformer.reshape(-1,3).mean(axis=0) for conformer in conformers ]
+    radii = [ np.max(np.linalg.norm(conformer.reshape(-1,3)-center,axis=1)) for conformer,center in zip(conformers,centers) ]
+    flags = [ atomflags(residue.names) for residue in residues ]
+    moving = [ np.any(conformer != conformer[:1],axis=(0,2)) for conformer in conformers ]
+
+    pairs = {}
+    for i in range(len(residues)):
+        for j in range(i+1,len(residues)):
+            if np.linalg.norm(centers[i]-centers[j]) > radii[i] + radii[j] + clashheavy: continue
+            table = 0
+            for imoving in [False,True]:
+                for jmoving in [False,True]:
+                    iatoms, jatoms = moving[i] == imoving, moving[j] == jmoving
+                    # Fixed atoms are taken from the first rotamer only
+                    x = conformers[i][:,iatoms] if imoving else conformers[i][:1,iatoms]
+                    y = conformers[j][:,jatoms] if jmoving else conformers[j][:1,jatoms]
+                    table = table + clash_table(x,flags[i][iatoms],residues[i],y,flags[j][jatoms],residues[j])
+            table = np.broadcast_to(table,(len(conformers[i]),len(conformers[j])))
+            if np.any(table):
+                pairs[(i,j)] = np.array(table)
+                pairs[(j,i)] = pairs[(i,j)].T
+    return pairs
+
+
+def clash_table(x,xflags,xresidue,y,yflags,yresidue):
+    """
+    Clashes between every pair of conformers of the atoms x (Kx,nx,3)
+    and y (Ky,ny,3), as a (Kx,Ky) table
+    """
+    from scipy.spatial import cKDTree
+    table = np.zeros((len(x),len(y)),dtype=int)
+    nx, ny = x.shape[1], y.shape[1]
+    if (nx == 0) or (ny == 0): return table
+    found = cKDTree(x.reshape(-1,3)).sparse_distance_matrix(cKDTree(y.reshape(-1,3)),clashheavy,output_type='ndarray')
+    a, b = found['i'].astype(int), found['j'].astype(int)
+    threshold = clashthreshold(xflags[a%nx],xresidue.resid,xresidue.chain,
+                               yflags[b%ny],yresidue.resid,yresidue.chain)
+    mask = found['v'] < threshold
+    return np.bincount((a[mask]//nx)*len(y) + b[mask]//ny,minlength=table.size).reshape(table.shape)
+
+
+def dead_end_elimination(selfs,pairs):
+    """
+    Goldstein dead-end elimination. Rotamer r of residue i is removed
+    if another rotamer t of i is better whatever the other residues
+    do. Returns the indices of the rotamers left for every residue.
+    """
+    alive = [ np.arange(len(energies)) for energies in selfs ]
+    neighbors = [ [ j for (k,j) in pairs if k == i ] for i in range(len(selfs)) ]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(selfs)):
+            if len(alive[i]) == 1: continue
+            r = alive[i]
+            # gain[r,t]: lowest energy difference of r over t
+            gain = selfs[i][r][:,None] - selfs[i][r][None,:]
+            for j in neighbors[i]:
+                table = pairs[(i,j)][np.ix_(r,alive[j])]
+                gain = gain + np.min(table[:,None,:]-table[None,:,:],axis=2)
+            np.fill_diagonal(gain,-1)
+            dead = np.any(gain > 0,axis=1)
+            if np.any(dead):
+                alive[i] = r[~dead]
+                changed = True
+    return alive
+
+
+def solve(selfs,pairs,alive,maxnodes=20000):
+    """
+    Rotamer of every residue (indices into selfs) with the lowest total
+    energy, solving every group of interacting residues separately by
+    branch and bound. If the search is not finished after maxnodes
+    nodes, the best assignment found so far is kept.
+    """
+    nresidues = len(selfs)
+    neighbors = [ set(j for (k,j) in pairs if k == i) for i in range(nresidues) ]
+    # Tables restricted to the rotamers left
+    S = [ selfs[i][alive[i]] for i in range(nresidues) ]
+    P = { (i,j): table[np.ix_(alive[i],alive[j])] for (i,j),table in pairs.items() }
+    local = [ int(np.argmin(S[i])) for i in range(nresidues) ]
+
+    # Groups of interacting residues
+    seen = set()
+    for start in range(nresidues):
+        if start in seen: continue
+        group, stack = [], [start]
+        seen.add(start)
+        while stack:
+            i = stack.pop()
+            group.append(i)
+            for j in neighbors[i]:
+                if j not in seen:
+                    seen.add(j)
+                    stack.append(j)
+        if len(group) == 1: continue
+
+        # Most connected residues first. cond[u] is the energy of the
+        # rotamers of u given the residues assigned so far.
+        group.sort(key=lambda i: (-len(neighbors[i]),i))
+        cond = { i: S[i].copy() for i in group }
+        best = [ sum(energy(S,P,local,group)), { i: local[i] for i in group } ]
+        assigned = {}
+        nodes = [0]
+
+        def search(depth,total):
+            nodes[0] += 1
+            if nodes[0] > maxnodes: return
+            if depth == len(group):
+                if total < best[0]:
+                    best[0] = total
+                    best[1] = dict(assigned)
+                return
+            i = group[depth]
+            rest = group[depth+1:]
+            # Lower bound of every rotamer of i, energies are not negative
+            bound = total + cond[i]
+            for u in rest:
+                if u in neighbors[i]:
+                    bound = bound + np.min(cond[u][:,None] + P[(u,i)],axis=0)
+                else:
+                    bound = bound + np.min(cond[u])
+            for k in np.argsort(bound,kind='stable'):
+                if bound[k] >= best[0]: break
+                assigned[i] = int(k)
+                for u in rest:
+                    if u in neighbors[i]: cond[u] += P[(u,i)][:,k]
+                search(depth+1,total+cond[i][k])
+                for u in rest:
+                    if u in neighbors[i]: cond[u] -= P[(u,i)][:,k]
+                del assigned[i]
+                if nodes[0] > maxnodes: return
+
+        search(0,0)
+        for i in group: local[i] = best[1][i]
+    return [ int(alive[i][local[i]]) for i in range(nresidues) ]
+
+
+def energy(selfs,pairs,choice,group):
+    """
+    Energy of every residue of a group, counting each pair once
+    """
+    result = []
+    for i in group:
+        value = selfs[i][choice[i]]
+        for j in group:
+            if (j > i) and ((i,j) in pairs): value += pairs[(i,j)][choice[i],choice[j]]
+        result.append(value)
+    return result
@@ -0,0 +1,285 @@
+import os
+import json
+import hashlib
+import zipfile
+import threading
+import numpy as np
+from collections import OrderedDict
+from ptmpsi.constants import clashheavy
+from ptmpsi.protein.journal import _SKIP
+
+
+class PlacementCache:
+    """
+    Cache of side-chain placements. Keys are built from the change
+    (template or PTM), the coordinates of the site and those of all
+    the atoms within reach of the new side chain, so a hit gives the
+    same residue the rotamer search would. The most recently used
+    maxsize placements are kept in memory, and if directory is given
+    they are also stored on disk (up to maxbytes, least recently used
+    files are evicted), so they survive between runs and processes.
+    Files on disk only hold arrays and JSON, nothing is unpickled.
+    """
+    def __init__(self,maxsize=1024,directory=None,maxbytes=1024**3):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.total = 0
+        if directory is not None:
+            os.makedirs(directory,exist_ok=True)
+            # Running size of the files, only rescanned to evict
+            self.total = sum(size for mtime,size,name in self.scan())
+        return
+
+
+    def key(self,protein,residue,change,reach,site=None):
+        """
+        Key of a change on residue. site are the atoms of the residue
+        the placement depends on (all if None), and reach the distance
+        from CA within which the environment is taken into account.
+        """
+        atoms = protein.atoms
+        site = np.arange(len(residue.names)) if site is None else np.asarray(site,dtype=int)
+        origin = residue.find_coord("CA")
+
+        # Environment atoms, with their residue numbers relative to the site
+        near = np.flatnonzero(np.linalg.norm(atoms.coordinates-origin,axis=1) <= reach)
+        present, inverse = np.unique(atoms.residue_index[near],return_inverse=True)
+        owners = [ atoms.residues[ires] for ires in present ]
+        keep = np.array([ owner is not residue for owner in owners ],dtype=bool)[inverse]
+        relative = np.array([ owner.resid-residue.resid if owner.chain == residue.chain else -10**6
+                              for owner in owners ],dtype=int)[inverse]
+        near, relative = near[keep], relative[keep]
+
+        digest = hashlib.sha256()
+        digest.update(str(change).encode())
+        digest.update(residue.names[site].astype('U4').tobytes())
+        digest.update((np.round(residue.coordinates[site],3)+0.0).astype('<f8').tobytes())
+        digest.update(atoms.names[near].astype('U4').tobytes())
+        digest.update(relative.astype('<i8').tobytes())
+        digest.update((np.round(atoms.coordinates[near],3)+0.0).astype('<f8').tobytes())
+        return digest.hexdigest()
+
+
+    def get(self,key):
+        """
+        Return a copy of the residue placed under key, or None
+        """
+        with self.lock:
+            placed = self.entries.get(key)
+            if placed is not None:
+                self.entries.move_to_end(key)
+        if (placed is None) and (self.directory is not None):
+            try:
+                placed = readplacement(self.path(key))
+                os.utime(self.path(key))
+                self.remember(key,placed)
+            except (OSError,ValueError,KeyError,zipfile.BadZipFile):
+                placed = None
+        with self.lock:
+            if placed is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if placed is None else detach(placed)
+
+
+    def put(self,key,residue):
+        """
+        Store a copy of the placed residue under key
+        """
+        placed = detach(residue)
+        self.remember(key,placed)
+        if self.directory is not None:
+            path = self.path(key)
+            tmp = "{}.{}.{}".format(path,os.getpid(),threading.get_ident())
+            writeplacement(tmp,placed)
+            size = os.path.getsize(tmp)
+            os.replace(tmp,path)
+            with self.lock:
+                self.total += size
+                if self.total > self.maxbytes:
+                    self.evict()
+        return
+
+
+    def remember(self,key,placed):
+        with self.lock:
+            self.entries[key] = placed
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return
+
+
+    def path(self,key):
+        return os.path.join(self.directory,key+".npz")
+
+
+    def scan(self):
+        """
+        Modification time, size and name of every stored file
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"): continue
+            # Other processes may remove files at the same time
+            try:
+                stat = os.stat(os.path.join(self.directory,name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime,stat.st_size,name))
+        return entries
+
+
+    def evict(self):
+        """
+        Remove the least recently used files until the disk cache fits
+        in maxbytes, with a 10% margin so that the next puts do not have
+        to scan the directory again. Must be called with the lock held.
+        """
+        entries = self.scan()
+        self.total = sum(entry[1] for entry in entries)
+        if self.total <= self.maxbytes: return
+        for mtime,size,name in sorted(entries):
+            if self.total <= 0.9*self.maxbytes: break
+            try:
+                os.remove(os.path.join(self.directory,name))
+            except FileNotFoundError:
+                pass
+            self.total -= size
+        return
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        return
+
+
+    def stats(self):
+        """
+        Hits, misses and evictions (from memory) so far
+        """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.entries)}
+
+
+def reach(coordinates,origin):
+    """
+    Largest distance from origin to any of the coordinates
+    """
+    return float(np.max(np.linalg.norm(np.asarray(coordinates)-origin,axis=1)))
+
+
+def rotamer_reach(coordinates,names):
+    """
+    Largest distance from CA that any atom can reach when the side
+    chain is rotated. Chi rotations keep the distances to CB, so no
+    atom gets further than |CA-CB| + |atom-CB|.
+    """
+    coordinates = np.asarray(coordinates)
+    names = [ str(name).strip() for name in names ]
+    ca = coordinates[names.index("CA")]
+    distance = reach(coordinates,ca)
+    if "CB" in names:
+        cb = coordinates[names.index("CB")]
+        distance = max(distance,float(np.linalg.norm(cb-ca)) + reach(coordinates,cb))
+    return distance
+
+
+def mutationkey(cache,protein,residue,template):
+    """
+    Cache key of a point mutation. The template is aligned on the N,
+    CA, C and O atoms of the site, so only those are part of the key.
+    """
+    site = list(residue.backbone) + [residue.find("O")]
+    distance = rotamer_reach(template.coordinates,template.elements[:,1]) + clashheavy
+    return cache.key(protein,residue,"mutation:"+template.name,distance,site)
+
+
+def modificationkey(cache,protein,residue,ptm,radical,hissite):
+    """
+    Cache key of a PTM that attaches radical to residue
+    """
+    distance = rotamer_reach(residue.coordinates,residue.names) + reach(radical.coordinates,np.zeros(3)) + 2.0 + clashheavy
+    return cache.key(protein,residue,"ptm:{}:{}".format(ptm,hissite),distance)
+
+
+def detach(residue):
+    """
+    Copy of a residue with private atom arrays and no owner Protein
+    """
+    placed = residue._clone()
+    placed._coordinates = np.array(residue.coordinates)
+    placed._names = np.array(residue.names)
+    placed._elements = np.array(residue.elements)
+    placed._view = False
+    placed._shared = False
+    placed._lookup = None
+    placed._torsions = None
+    return placed
+
+
+def writeplacement(filename,placed):
+    """
+    Write a placed residue as a NumPy archive: its atom arrays, its
+    array attributes and a JSON header with the scalar ones
+    """
+    arrays = {"coordinates": np.asarray(placed.coordinates,dtype=float),
+              "names": np.asarray(placed.names).astype('U4'),
+              "elements": np.asarray(placed.elements).astype('U4')}
+    header = {"name": str(placed.name)}
+    for key,value in placed.__dict__.items():
+        if key in _SKIP: continue
+        if isinstance(value,np.ndarray):
+            arrays["attribute_"+key] = value
+            continue
+        if isinstance(value,np.generic): value = value.item()
+        if (value is None) or isinstance(value,(str,int,float,bool)):
+            header[key] = value
+    arrays["header"] = np.array(json.dumps(header))
+    with open(filename,'wb') as fh:
+        np.savez(fh,**arrays)
+    return
+
+
+def readplacement(filename):
+    """
+    Read a residue written by writeplacement
+    """
+    from ptmpsi.residues import Residue
+    with np.load(filename,allow_pickle=False) as data:
+        header = json.loads(str(data["header"]))
+        placed = Residue(header.pop("name"),len(data["coordinates"]))
+        placed.coordinates = np.array(data["coordinates"])
+        placed.names = np.array(data["names"])
+        placed.elements = np.array(data["elements"])
+        for key in data.files:
+            if key.startswith("attribute_"):
+                setattr(placed,key[len("attribute_"):],np.array(data[key]))
+    for key,value in header.items():
+        setattr(placed,key,value)
+    return placed
+
+
+def assign(residue,placed):
+    """
+    Give residue the atoms and attributes of a placed copy of it
+    """
+    residue._checkpoint()
+    residue.coordinates = np.array(placed.coordinates)
+    residue.names = np.array(placed.names)
+    residue.elements = np.array(placed.elements)
+    state = { key: value for key,value in placed.__dict__.items()
+              if key not in _SKIP and key not in ["resid","chain"] }
+    residue.__dict__.update(state)
+    residue.backbone = np.array(placed.backbone)
+    residue.name = placed.name
+    return
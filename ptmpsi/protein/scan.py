@@ -0,0 +1,205 @@
+import io
+import os
+import csv
+import contextlib
+import numpy as np
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from ptmpsi.math import find_clashes_residue, get_torsion
+from ptmpsi.math.neighbors import NeighborIndex
+from ptmpsi.protein.mutate import point_mutation, post_translational_modification, _CYSPTMS
+from ptmpsi.residues import ptmdict, ptm2nonstandard, three2one, one2three
+from ptmpsi.residues.ptms import ptmsite, check_ptm
+from ptmpsi.exceptions import MyDockingError
+from ptmpsi.protein.tools import get_residue
+from ptmpsi.protein.placement import PlacementCache
+from ptmpsi.io.snapshot import snapshotarrays, buildsnapshot
+
+AMINOACIDS = ["ALA","ARG","ASN","ASP","CYS","GLN","GLU","GLY","HIS","ILE",
+              "LEU","LYS","MET","PHE","PRO","SER","THR","TRP","TYR","VAL"]
+
+_COLUMNS = ["chain","resid","wildtype","mutant","clashes","chi1","chi2","pdb","error"]
+_PTMCOLUMNS = ["chain","resid","residue","ptm","clashes","pdb","error"]
+
+# Wild-type Protein of each worker process, built once by _initworker
+_worker = {}
+
+
+def saturation_mutagenesis(protein,positions,output,workers=None,pdbdir=None,chunksize=1,cachedir=None):
+    """
+    Mutate every residue in positions to the other 19 standard amino
+    acids in a pool of worker processes. The wild-type coordinates
+    are handed to the workers through shared memory, and each worker
+    rebuilds the Protein once. Results (clashes and chi angles of
+    the final rotamer) are written to the CSV table output as they
+    finish. If pdbdir is given, every variant is also saved there.
+    Placements are kept in a PlacementCache in cachedir, if given.
+    """
+    residues = [ get_residue(protein,position) for position in positions ]
+    tasks = [ (residue.chain,residue.resid,str(residue.name),new) for residue in residues
+              for new in AMINOACIDS if new != standard(residue.name) ]
+    print("\t Scanning {} variants at {} positions".format(len(tasks),len(residues)))
+    runpool(protein,_mutate,tasks,_COLUMNS,output,workers,pdbdir,chunksize,cachedir)
+    return
+
+
+def standard(resname):
+    """
+    Standard amino acid of a protonation or bonding variant (HID, CYX...)
+    """
+    return one2three.get(three2one.get(str(resname),""),str(resname))
+
+
+def ptm_sites(protein,ptms=None,minconfidence=None,maxneighbors=None,radius=10.0):
+    """
+    All the (residue, ptm) pairs of a Protein where the PTM can be
+    applied. Residues with a B-factor (pLDDT in AlphaFold models)
+    below minconfidence, or with more than maxneighbors heavy atoms
+    within radius of the modified atom (buried), are left out.
+    """
+    if ptms is None: ptms = list(ptmdict.keys())
+    residues = [ residue for chain in protein.chains for residue in chain.residues ]
+    if minconfidence is not None:
+        residues = [ residue for residue in residues if getattr(residue,"bfactor",0.0) >= minconfidence ]
+
+    sites = [ (residue,ptm) for residue in residues for ptm in ptms if ptm_compatible(residue.name,ptm) ]
+    if (maxneighbors is not None) and (len(sites) > 0):
+        unique = list({ id(residue): residue for residue,ptm in sites }.values())
+        counts = dict(zip([id(residue) for residue in unique],exposure(protein,unique,radius)))
+        sites = [ (residue,ptm) for residue,ptm in sites if counts[id(residue)] <= maxneighbors ]
+    return sites
+
+
+def ptm_compatible(resname,ptm):
+    """
+    Whether ptm can be applied to a residue named resname. Radicals
+    can only be attached to residues with a site in ptmsite.
+    """
+    if (resname in ["CYS","CYM"]) and (ptm in ptm2nonstandard):
+        return True
+    if ptm in _CYSPTMS: return False
+    if ptmdict.get(ptm) is None: return False
+    if (resname not in ptmsite) and (resname not in ["HIS","HIP","HID","HIE"]): return False
+    try:
+        return check_ptm(resname,ptm) is not None
+    except MyDockingError:
+        return False
+
+
+def exposure(protein,residues,radius=10.0):
+    """
+    Number of heavy atoms of the Protein, other than those of the
+    residue itself, within radius of the atom of each residue that
+    would be modified (CA if there is none). Low counts mean exposed.
+    """
+    index = NeighborIndex([protein])
+    heavy = ~index.flags["hydrogen"]
+    counts = []
+    for residue in residues:
+        site = ptmsite.get(residue.name)
+        atom = site[2] if (site is not None) and (site[2] in residue.names) else "CA"
+        near = np.array(index.tree.query_ball_point(residue.find_coord(atom),radius),dtype=int)
+        same = (index.resid[near] == residue.resid) & (index.chain[near] == residue.chain)
+        counts.append(int(np.count_nonzero(heavy[near] & ~same)))
+    return counts
+
+
+def ptm_scan(protein,output,ptms=None,minconfidence=None,maxneighbors=None,radius=10.0,
+             workers=None,pdbdir=None,chunksize=1,hissite="clashes",cachedir=None):
+    """
+    Apply every compatible PTM (see ptm_sites) to every residue of
+    the Protein, one variant at a time, in a pool of worker processes.
+    Results are written to the CSV table output as they finish, and
+    if pdbdir is given every variant is also saved there. hissite is
+    the (non-interactive) policy for histidines, see select_hissite.
+    Placements are kept in a PlacementCache in cachedir, if given.
+    """
+    if str(hissite).lower() == "ask":
+        raise MyDockingError("Workers cannot ask for the histidine site, use another policy")
+    sites = ptm_sites(protein,ptms,minconfidence,maxneighbors,radius)
+    tasks = [ (residue.chain,residue.resid,str(residue.name),ptm,hissite) for residue,ptm in sites ]
+    print("\t Scanning {} modified variants".format(len(tasks)))
+    runpool(protein,_modify,tasks,_PTMCOLUMNS,output,workers,pdbdir,chunksize,cachedir)
+    return
+
+
+def runpool(protein,function,tasks,columns,output,workers=None,pdbdir=None,chunksize=1,cachedir=None):
+    """
+    Run function over the tasks in a pool of worker processes that
+    share the coordinates of the Protein, writing the rows returned
+    to the CSV table output as they arrive
+    """
+    if pdbdir is not None: os.makedirs(pdbdir,exist_ok=True)
+
+    header, arrays = snapshotarrays(protein)
+    coordinates = arrays.pop("coordinates")
+    memory = SharedMemory(create=True,size=max(coordinates.nbytes,1))
+    try:
+        np.ndarray(coordinates.shape,dtype=coordinates.dtype,buffer=memory.buf)[:] = coordinates
+        initargs = (memory.name,coordinates.shape,header,arrays,pdbdir,cachedir)
+        with Pool(workers,initializer=_initworker,initargs=initargs) as pool, open(output,'w',newline='') as fh:
+            writer = csv.DictWriter(fh,fieldnames=columns)
+            writer.writeheader()
+            nerrors = 0
+            for row in pool.imap_unordered(function,tasks,chunksize):
+                writer.writerow(row)
+                fh.flush()
+                if row["error"]: nerrors += 1
+        print("\t Wrote {} variants to {} ({} failed)".format(len(tasks),output,nerrors))
+    finally:
+        memory.close()
+        memory.unlink()
+    return
+
+
+def _initworker(name,shape,header,arrays,pdbdir,cachedir):
+    # The parent owns the block and unlinks it
+    memory = SharedMemory(name=name)
+    arrays = dict(arrays)
+    arrays["coordinates"] = np.ndarray(shape,dtype=float,buffer=memory.buf)
+    protein = buildsnapshot(header,arrays)
+    # Variants are copy-on-write clones, the shared block is never written
+    protein.atoms.share()
+    cache = None if cachedir is None else PlacementCache(directory=cachedir)
+    _worker.update(memory=memory,protein=protein,pdbdir=pdbdir,cache=cache)
+    return
+
+
+def _mutate(task):
+    chain, resid, wildtype, new = task
+    row = dict(chain=chain,resid=resid,wildtype=wildtype,mutant=new,
+               clashes=None,chi1=None,chi2=None,pdb=None,error=None)
+    protein = _worker["protein"].clone()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            residue = protein.getchain(chain).residues[resid-1]
+            point_mutation(protein,residue,new,_worker["cache"])
+            row["clashes"] = find_clashes_residue(residue,[protein],printing=False)
+        for key in ["chi1","chi2"]:
+            chi = getattr(residue,key)
+            if chi is not None:
+                row[key] = round(float(get_torsion(*residue.coordinates[chi])),1)
+        if _worker["pdbdir"] is not None:
+            row["pdb"] = os.path.join(_worker["pdbdir"],"{}_{}{}{}.pdb".format(chain,wildtype,resid,new))
+            protein.write_pdb(row["pdb"])
+    except Exception as error:
+        row["error"] = " ".join(str(error).split())
+    return row
+
+
+def _modify(task):
+    chain, resid, resname, ptm, hissite = task
+    row = dict(chain=chain,resid=resid,residue=resname,ptm=ptm,
+               clashes=None,pdb=None,error=None)
+    protein = _worker["protein"].clone()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            residue = protein.getchain(chain).residues[resid-1]
+            post_translational_modification(protein,residue,ptm,hissite,_worker["cache"])
+            row["clashes"] = find_clashes_residue(residue,[protein],printing=False)
+        if _worker["pdbdir"] is not None:
+            row["pdb"] = os.path.join(_worker["pdbdir"],"{}_{}{}_{}.pdb".format(chain,resname,resid,ptm.replace(" ","_")))
+            protein.write_pdb(row["pdb"])
+    except Exception as error:
+        row["error"] = " ".join(str(error).split())
+    return row
@@ -0,0 +1,317 @@
+import numpy as np
+
+
+class AtomStore:
+    """
+    Structure-of-arrays representation of all the atoms in a Protein.
+    Coordinates, names and elements are kept in contiguous arrays, and
+    every Residue in the Protein is rebound to a view into them.
+    Existing columns (e.g. memory-mapped from a snapshot) can be given
+    instead of gathering them from the residues.
+
+    The arrays are views into buffers with spare capacity, so residues
+    inserted into a chain or whose atoms were replaced are spliced in
+    place, and only the residues after them are rebound.
+    """
+    def __init__(self,protein,coordinates=None,names=None,elements=None):
+        self.protein  = protein
+        self.chains   = list(protein.chains)
+        self.residues = [residue for chain in self.chains for residue in chain.residues]
+
+        # Residue offsets for each chain
+        nresidues = [len(chain.residues) for chain in self.chains]
+        self.choffsets = np.zeros(len(self.chains)+1,dtype=int)
+        self.choffsets[1:] = np.cumsum(nresidues)
+
+        # Atom offsets for each residue
+        natoms = [len(residue._coordinates) for residue in self.residues]
+        self.resoffsets = np.zeros(len(self.residues)+1,dtype=int)
+        self.resoffsets[1:] = np.cumsum(natoms)
+        self.natoms = int(self.resoffsets[-1])
+
+        # Contiguous per-atom columns
+        if coordinates is not None:
+            self._coordinates = coordinates
+            self._names = names
+            self._elements = elements
+        elif self.natoms > 0:
+            self._coordinates = np.concatenate([residue._coordinates for residue in self.residues]).astype(float,copy=False)
+            self._names = np.concatenate([residue._names for residue in self.residues])
+            self._elements = np.concatenate([residue._elements for residue in self.residues])
+        else:
+            self._coordinates = np.empty((0,3),dtype=float)
+            self._names = np.empty(0,dtype='U4')
+            self._elements = np.empty(0,dtype='U4')
+        self.shared = False
+        self._columns()
+
+        # Rebind every residue as a view into the store
+        self._stale = []
+        self._position = None
+        self._bind(0)
+
+        for chain in self.chains:
+            chain._protein = protein
+
+        self._chainpos = { id(chain): ichain for ichain,chain in enumerate(self.chains) }
+        return
+
+
+    def _columns(self):
+        self.coordinates = self._coordinates[:self.natoms]
+        self.names = self._names[:self.natoms]
+        self.elements = self._elements[:self.natoms]
+        # Columns shared with a clone are read-only
+        if self.shared:
+            for column in [self.coordinates, self.names, self.elements]:
+                column.flags.writeable = False
+        return
+
+
+    def _bind(self,start,stop=None,fresh=None):
+        # Point residues start to stop at their slices of the store. If the
+        # fresh range is given, stale residues outside of it are skipped.
+        if stop is None: stop = len(self.residues)
+        for ires in range(start,stop):
+            residue = self.residues[ires]
+            if (fresh is not None) and (not residue._view) and not (fresh[0] <= ires < fresh[1]): continue
+            first, last = self.resoffsets[ires], self.resoffsets[ires+1]
+            residue._coordinates = self.coordinates[first:last]
+            residue._names = self.names[first:last]
+            residue._elements = self.elements[first:last]
+            residue._view = True
+            residue._shared = False
+            residue._protein = self.protein
+        return
+
+
+    def share(self):
+        """
+        Mark the buffers as shared with a clone. The first modification
+        of either store, or of any of their residues, copies them.
+        """
+        if not self.shared:
+            self.shared = True
+            self._columns()
+            for residue in self.residues:
+                if residue._view: residue._shared = True
+        return
+
+
+    def unshare(self):
+        """
+        Give the store private copies of its buffers
+        """
+        self._coordinates = np.array(self.coordinates)
+        self._names = np.array(self.names)
+        self._elements = np.array(self.elements)
+        self.shared = False
+        self._columns()
+        self._bind(0,fresh=(0,0))
+        return
+
+
+    def clone(self,protein):
+        """
+        Store of a cloned Protein, sharing the buffers of this one
+        (which must have been marked with share() first)
+        """
+        atoms = AtomStore.__new__(AtomStore)
+        atoms.__dict__.update(self.__dict__)
+        atoms.protein = protein
+        atoms.chains = list(protein.chains)
+        atoms.residues = [residue for chain in atoms.chains for residue in chain.residues]
+        atoms.resoffsets = self.resoffsets.copy()
+        atoms.choffsets = self.choffsets.copy()
+        atoms._stale = []
+        atoms._position = None
+        atoms._chainpos = { id(chain): ichain for ichain,chain in enumerate(atoms.chains) }
+        return atoms
+
+
+    def matches(self,protein):
+        """
+        Check that the chains still hold the residues known to the store
+        """
+        if len(protein.chains) != len(self.chains): return False
+        for ichain,chain in enumerate(protein.chains):
+            if chain is not self.chains[ichain]: return False
+            if len(chain.residues) != self.choffsets[ichain+1] - self.choffsets[ichain]: return False
+        return True
+
+
+    def _reserve(self,natoms,names,elements):
+        # Grow the buffers (doubling their size) if they cannot hold natoms
+        # atoms, or if the new names and elements need a longer string type
+        dtypes = [np.result_type(self._names.dtype,names.dtype), np.result_type(self._elements.dtype,elements.dtype)]
+        if (natoms <= len(self._coordinates)) and (dtypes[0] == self._names.dtype) and (dtypes[1] == self._elements.dtype):
+            return False
+        capacity = max(natoms,2*len(self._coordinates),16)
+        coordinates = np.empty((capacity,3),dtype=float)
+        _names = np.empty(capacity,dtype=dtypes[0])
+        _elements = np.empty(capacity,dtype=dtypes[1])
+        coordinates[:self.natoms] = self.coordinates
+        _names[:self.natoms] = self.names
+        _elements[:self.natoms] = self.elements
+        self._coordinates, self._names, self._elements = coordinates, _names, _elements
+        return True
+
+
+    def _splice(self,start,stop,residues,ichain=None):
+        """
+        Replace the atoms of residues start to stop (in chain ichain)
+        with the atoms currently held by the given residues
+        """
+        if self.shared: self.unshare()
+        natoms = [len(residue._coordinates) for residue in residues]
+        first, last = self.resoffsets[start], self.resoffsets[stop]
+        delta = sum(natoms) - (last - first)
+
+        if len(residues) > 0:
+            names = np.concatenate([residue._names for residue in residues])
+            elements = np.concatenate([residue._elements for residue in residues])
+            coordinates = np.concatenate([residue._coordinates for residue in residues])
+        else:
+            names = elements = np.empty(0,dtype='U4')
+        moved = self._reserve(self.natoms+delta,names,elements)
+
+        # Shift the atoms after the spliced residues and copy the new ones
+        end = self.natoms
+        if delta != 0:
+            for buffer in [self._coordinates, self._names, self._elements]:
+                buffer[last+delta:end+delta] = buffer[last:end].copy()
+        if len(residues) > 0:
+            self._coordinates[first:first+len(names)] = coordinates
+            self._names[first:first+len(names)] = names
+            self._elements[first:first+len(names)] = elements
+        self.natoms += delta
+        self._columns()
+
+        # Residue and chain offsets
+        if ichain is None:
+            ichain = np.searchsorted(self.choffsets,start,side='right') - 1
+        self.resoffsets = np.concatenate([self.resoffsets[:start+1], first + np.cumsum(natoms,dtype=int),
+                                          self.resoffsets[stop+1:] + delta])
+        self.choffsets[ichain+1:] += len(residues) - (stop - start)
+        self.residues[start:stop] = residues
+
+        # Residues that moved in memory must be rebound
+        fresh = (start,start+len(residues))
+        if moved:
+            self._bind(0,fresh=fresh)
+        elif (delta != 0) or (len(residues) != stop - start):
+            self._bind(start,fresh=fresh)
+        else:
+            self._bind(start,fresh[1],fresh)
+        if (len(residues) != stop - start) and (start + len(residues) < len(self.residues)):
+            self._position = None
+        elif self._position is not None:
+            for ires in range(start,start+len(residues)):
+                self._position[id(self.residues[ires])] = ires
+        return
+
+
+    def insert(self,chain,position,residue):
+        """
+        Insert the atoms of a residue added to a chain at position
+        """
+        ichain = self._chainpos[id(chain)]
+        ires = self.choffsets[ichain] + position
+        self._splice(ires,ires,[residue],ichain)
+        return
+
+
+    def remove(self,chain,position):
+        """
+        Remove the atoms of the residue at position of a chain. The
+        residue keeps a private copy of its atoms.
+        """
+        ichain = self._chainpos[id(chain)]
+        ires = self.choffsets[ichain] + position
+        residue = self.residues[ires]
+        if residue._view:
+            residue._coordinates = np.array(residue._coordinates)
+            residue._names = np.array(residue._names)
+            residue._elements = np.array(residue._elements)
+            residue._view = False
+            residue._shared = False
+        self._splice(ires,ires+1,[],ichain)
+        return
+
+
+    def stale(self,residue):
+        """
+        Mark a residue whose atom arrays were replaced, it will be
+        spliced back into the store on the next refresh
+        """
+        self._stale.append(residue)
+        return
+
+
+    def refresh(self):
+        """
+        Splice the stale residues back into the store. Returns False if
+        a residue is not known to the store, which must then be rebuilt.
+        """
+        if len(self._stale) == 0: return True
+        if self._position is None:
+            self._position = { id(residue): ires for ires,residue in enumerate(self.residues) }
+        stale, self._stale = self._stale, []
+        for residue in stale:
+            if residue._view: continue
+            ires = self._position.get(id(residue))
+            if ires is None: return False
+            self._splice(ires,ires+1,[residue])
+        return True
+
+
+    def has_chain(self,chain):
+        return id(chain) in self._chainpos
+
+
+    def chain_slice(self,chain):
+        """
+        Return the slice of atoms that belong to a chain
+        """
+        ichain = self._chainpos[id(chain)]
+        start = self.resoffsets[self.choffsets[ichain]]
+        stop  = self.resoffsets[self.choffsets[ichain+1]]
+        return slice(start,stop)
+
+
+    def residue_slice(self,ires):
+        """
+        Return the slice of atoms that belong to the ires-th residue
+        """
+        return slice(self.resoffsets[ires],self.resoffsets[ires+1])
+
+
+    @property
+    def residue_index(self):
+        """
+        Index of the residue each atom belongs to
+        """
+        return np.repeat(np.arange(len(self.residues)),np.diff(self.resoffsets))
+
+
+    @property
+    def chain_index(self):
+        """
+        Index of the chain each atom belongs to
+        """
+        return np.repeat(np.arange(len(self.chains)),np.diff(self.resoffsets[self.choffsets]))
+
+
+    @property
+    def resnames(self):
+        return np.array([residue.name for residue in self.residues],dtype='U4')
+
+
+    @property
+    def resids(self):
+        return np.array([residue.resid for residue in self.residues],dtype=int)
+
+
+    @property
+    def chainnames(self):
+        return np.array([residue.chain for residue in self.residues])
@@ -27,12 +27,7 @@ def get_residue(protein,residue):
         resnum = int(residue[lower:])
         # Get the Residue instance
         if chain is not None:
-            _residue = None
-            for _chain in protein.chains:
-                if _chain.name == chain:
-                    _residue = _chain.residues[resnum-1]
-                    break
-            if _residue is None: raise MyDockingError("There is no chain '{}' in protein".format(chain))
+            _residue = protein.getchain(chain).residues[resnum-1]
         else:
             _residue = protein.chains[0].residues[resnum-1]
         # Check that the name and number correspond
@@ -1,11 +1,18 @@
+import importlib
 import numpy as np
-from . import aminoacids
-from . import nonstandard
-from . import ptms
+from collections.abc import Mapping
 from ptmpsi.exceptions import MyDockingError
+from ptmpsi.math import torsion_tree
 
 class Residue:
+    # Atom arrays shared with a clone until either is modified
+    _shared = False
+
     def __init__(self, resname, natoms):
+        self._protein = None
+        self._view = False
+        self._lookup = None
+        self._torsions = None
         self.name = resname
         self.natoms = natoms
         self.names = np.empty(self.natoms,dtype='U4')
@@ -15,34 +22,164 @@ class Residue:
         self.resid = None
         self.chain = None
 
+    def __getstate__(self):
+        # Do not drag the owner Protein along when copying or pickling
+        # a single residue, it will be re-attached on the next packing
+        state = self.__dict__.copy()
+        state["_protein"] = None
+        state["_shared"] = False
+        return state
+
+    def _clone(self,protein=None):
+        # Shallow copy that shares the atom arrays, see Protein.clone
+        residue = Residue.__new__(Residue)
+        residue.__dict__.update(self.__dict__)
+        residue._protein = protein
+        residue.backbone = np.array(self.backbone)
+        return residue
+
+    def _checkpoint(self):
+        # Save the state of the residue in the open transaction of its
+        # Protein, before it is modified
+        if (self._protein is not None) and self._protein._journal:
+            self._protein._journal[-1].save(self)
+        return
+
+    def _unshare(self):
+        # Copy-on-write: before the atoms of a cloned residue can be
+        # modified, its Protein gets a private copy of the atom store.
+        # Must be called before writing into the atom arrays in place.
+        atoms = None if self._protein is None else self._protein._atoms
+        if (atoms is not None) and atoms.shared:
+            atoms.unshare()
+        if self._shared:
+            self._shared = False
+            self._coordinates = np.array(self._coordinates)
+            self._names = np.array(self._names)
+            self._elements = np.array(self._elements)
+            self._replaced()
+        return
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self,value):
+        old = getattr(self,"_name",None)
+        self._name = value
+        # Keep the residue index of the owner Protein up to date
+        if (old is not None) and (self._protein is not None) and (getattr(self._protein,"_index",None) is not None):
+            self._protein._index.rename(self,old)
+
+    def _replaced(self):
+        # The atom arrays no longer live in the Protein atom store
+        self._view = False
+        if (self._protein is not None) and (self._protein._atoms is not None):
+            self._protein._atoms.stale(self)
+        return
+
+    @property
+    def coordinates(self):
+        if self._shared: return _readonly(self._coordinates)
+        return self._coordinates
+
+    @coordinates.setter
+    def coordinates(self,value):
+        if self._shared: self._unshare()
+        value = np.asarray(value)
+        # Write in place if the residue is a view of the atom store
+        if self._view and (value.shape == self._coordinates.shape):
+            self._coordinates[...] = value
+        else:
+            self._coordinates = value
+            self._replaced()
+
+    @property
+    def names(self):
+        if self._shared: return _readonly(self._names)
+        return self._names
+
+    @names.setter
+    def names(self,value):
+        if self._shared: self._unshare()
+        self._names = np.asarray(value)
+        self._lookup = None
+        self._torsions = None
+        self._replaced()
+
+    @property
+    def elements(self):
+        if self._shared: return _readonly(self._elements)
+        return self._elements
+
+    @elements.setter
+    def elements(self,value):
+        if self._shared: self._unshare()
+        self._elements = np.asarray(value)
+        self._replaced()
+
     def __eq__(self,other):
         if (self.resid == other.resid) and (self.chain == other.chain) and (self.name == other.name):
             return True
         else:
             return False
 
+    def _nameindex(self):
+        # Name to position map, rebuilt only after names are reassigned.
+        # The first occurrence of a repeated name wins.
+        if self._lookup is None:
+            names = self._names.tolist()
+            self._lookup = dict(zip(reversed(names),range(len(names)-1,-1,-1)))
+        return self._lookup
+
     def find(self,atom):
-        pos = next((idx for idx,val in np.ndenumerate(self.names) if val==atom),None)
+        pos = self._nameindex().get(atom)
         if pos is None:
             raise MyDockingError("Atom '{}' was not found in Residue '{}:{}{}'".format(atom,self.chain,self.name,self.resid))
-        return pos[0]
+        return pos
+
+    def find_many(self,atoms):
+        return np.array([self.find(atom) for atom in atoms],dtype=int)
 
     def find_coord(self,atom):
         return self.coordinates[self.find(atom)]
 
+    def moving(self,atoms):
+        """
+        Atoms that move when rotating the dihedral atoms=(a,b,c,d),
+        derived once from the bond connectivity of the residue template
+        (see template_bonds for atoms not in it) and cached until its
+        names change.
+        """
+        key = (int(atoms[1]),int(atoms[2]))
+        if self._torsions is None:
+            self._torsions = {}
+        if key not in self._torsions:
+            # Fall back to the atom name when the element is missing
+            elements = [ element if str(element).strip() else str(name).strip()[:1]
+                         for element,name in zip(self.elements,self.names) ]
+            template = resdict.get(self.name)
+            mask = torsion_tree(elements,self.coordinates,[atoms],self.names,template)[0]
+            if mask is None:
+                raise MyDockingError("Dihedral {} of Residue '{}:{}{}' is part of a ring".format(
+                    "-".join(self.names[atoms]),self.chain,self.name,self.resid))
+            self._torsions[key] = mask
+        return self._torsions[key]
+
 
 
 three2one = {
         "ACE": "X",
         "ALA": "A",
         "ARG": "R",
-        "ASH": "N",
+        "ASH": "D",
         "ASN": "N",
         "ASP": "D",
         "CYM": "C",
         "CYS": "C",
         "CYX": "C",
-        "GLH": "Q",
+        "GLH": "E",
         "GLN": "Q",
         "GLU": "E",
         "GLY": "G",
@@ -91,77 +228,117 @@ one2three = {
         "V": "VAL",
         }
 
-resdict = { "ACE": aminoacids.ACE,
-            "ALA": aminoacids.ALA,
-            "ARG": aminoacids.ARG,
-            "ASH": aminoacids.ASH,
-            "ASN": aminoacids.ASN,
-            "ASP": aminoacids.ASP,
-            "CYM": aminoacids.CYM,
-            "CYS": aminoacids.CYS,
-            "CYX": aminoacids.CYX,
-            "GLH": aminoacids.GLH,
-            "GLN": aminoacids.GLN,
-            "GLU": aminoacids.GLU,
-            "GLY": aminoacids.GLY,
-            "HID": aminoacids.HID,
-            "HIE": aminoacids.HIE,
-            "HIP": aminoacids.HIP,
-            "HIS": aminoacids.HIP,
-            "ILE": aminoacids.ILE,
-            "LEU": aminoacids.LEU,
-            "LYN": aminoacids.LYN,
-            "LYS": aminoacids.LYS,
-            "MET": aminoacids.MET,
-            "NHE": aminoacids.NHE,
-            "NME": aminoacids.NME,
-            "PHE": aminoacids.PHE,
-            "PRO": aminoacids.PRO,
-            "SER": aminoacids.SER,
-            "THR": aminoacids.THR,
-            "TRP": aminoacids.TRP,
-            "TYR": aminoacids.TYR,
-            "VAL": aminoacids.VAL,
+def _readonly(array):
+    # View of an array shared with a clone, which cannot be written
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+class LazyDict(Mapping):
+    """
+    Read-only dictionary of residue templates and PTM radicals. Values
+    are given as (module, name) pairs and are only loaded the first time
+    they are accessed, residue templates from the compiled library.
+    """
+    def __init__(self,entries):
+        self._entries = entries
+        self._values = {}
+
+    def __getitem__(self,key):
+        if key not in self._values:
+            entry = self._entries[key]
+            if entry is not None:
+                from ptmpsi.residues.library import template
+                entry = template(*entry)
+            self._values[key] = entry
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def __getattr__(name):
+    # Template modules are imported on first access
+    if name in ["aminoacids","nonstandard","ptms"]:
+        return importlib.import_module("ptmpsi.residues."+name)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__,name))
+
+
+resdict = LazyDict({ "ACE": ("aminoacids","ACE"),
+            "ALA": ("aminoacids","ALA"),
+            "ARG": ("aminoacids","ARG"),
+            "ASH": ("aminoacids","ASH"),
+            "ASN": ("aminoacids","ASN"),
+            "ASP": ("aminoacids","ASP"),
+            "CYM": ("aminoacids","CYM"),
+            "CYS": ("aminoacids","CYS"),
+            "CYX": ("aminoacids","CYX"),
+            "GLH": ("aminoacids","GLH"),
+            "GLN": ("aminoacids","GLN"),
+            "GLU": ("aminoacids","GLU"),
+            "GLY": ("aminoacids","GLY"),
+            "HID": ("aminoacids","HID"),
+            "HIE": ("aminoacids","HIE"),
+            "HIP": ("aminoacids","HIP"),
+            "HIS": ("aminoacids","HIP"),
+            "ILE": ("aminoacids","ILE"),
+            "LEU": ("aminoacids","LEU"),
+            "LYN": ("aminoacids","LYN"),
+            "LYS": ("aminoacids","LYS"),
+            "MET": ("aminoacids","MET"),
+            "NHE": ("aminoacids","NHE"),
+            "NME": ("aminoacids","NME"),
+            "PHE": ("aminoacids","PHE"),
+            "PRO": ("aminoacids","PRO"),
+            "SER": ("aminoacids","SER"),
+            "THR": ("aminoacids","THR"),
+            "TRP": ("aminoacids","TRP"),
+            "TYR": ("aminoacids","TYR"),
+            "VAL": ("aminoacids","VAL"),
 #
-            "QCS": nonstandard.QCS,
-            "XCN": nonstandard.XCN,
-            "SMC": nonstandard.SMC,
-            "SNC": nonstandard.SNC,
-            "CSD": nonstandard.CSD,
-            "CSO": nonstandard.CSO,
-            "OCS": nonstandard.OCS,
-            "CSS": nonstandard.CSS,
-            "CGL": nonstandard.CGL,
-            "EAC": nonstandard.EAC,
-            "ABA": nonstandard.ABA,
-            "IYY": nonstandard.IYY,
-        }
+            "QCS": ("nonstandard","QCS"),
+            "XCN": ("nonstandard","XCN"),
+            "SMC": ("nonstandard","SMC"),
+            "SNC": ("nonstandard","SNC"),
+            "CSD": ("nonstandard","CSD"),
+            "CSO": ("nonstandard","CSO"),
+            "OCS": ("nonstandard","OCS"),
+            "CSS": ("nonstandard","CSS"),
+            "CGL": ("nonstandard","CGL"),
+            "EAC": ("nonstandard","EAC"),
+            "ABA": ("nonstandard","ABA"),
+            "IYY": ("nonstandard","IYY"),
+        })
 
-ptmdict = {
-        "acetylation": ptms.acetylation,
+ptmdict = LazyDict({
+        "acetylation": ("ptms","acetylation"),
         "citrullination": None,
         "cysteinylation": None,
         "glutathionylation": None,
         "glycosylation": None,
         "hydroxylation": None,
-        "methylation": ptms.methylation,
+        "methylation": ("ptms","methylation"),
         "myristoylation": None,
         "nitration": None,
         "nitrosylation": None,
         "palmitoylation": None,
-        "phosphorylation": ptms.phosphorylation,
+        "phosphorylation": ("ptms","phosphorylation"),
         "prenylation": None,
         "sulfhydration": None,
         "sulfenylation": None,
         "sulfinylation": None,
         "sulfonylation": None,
-        "dimethylation": ptms.methylation,
-        "trimethylation": ptms.methylation,
-        "symmetric dimethylation": ptms.methylation,
-        "asymmetric dimethylation": ptms.methylation,
+        "dimethylation": ("ptms","methylation"),
+        "trimethylation": ("ptms","methylation"),
+        "symmetric dimethylation": ("ptms","methylation"),
+        "asymmetric dimethylation": ("ptms","methylation"),
         "cyanylation": None,
         "carbamoylation": None,
-        }
+        })
 
 ptm2nonstandard = {
         "glutathionylation": "CGL",
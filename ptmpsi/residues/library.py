@@ -0,0 +1,195 @@
+import os
+import hashlib
+import importlib
+import numpy as np
+from ptmpsi.residues.template import Template
+from ptmpsi.exceptions import MyDockingError
+
+# Modules with residue templates compiled into the library
+_modules = ["aminoacids", "nonstandard"]
+# Sources that determine the contents of the compiled library
+_sources = ["aminoacids.py", "nonstandard.py", "template.py", "library.py",
+            os.path.join("..", "constants", "__init__.py"), os.path.join("..", "math", "__init__.py")]
+_MAGIC = b"PTMPSTPL"
+
+_library = None
+
+
+def sourcehash():
+    """
+    Hash of the source files that define the residue templates
+    """
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for source in _sources:
+        with open(os.path.join(directory,source),'rb') as fh:
+            digest.update(fh.read())
+    return digest.hexdigest()[:16]
+
+
+def libraryfile():
+    from ptmpsi.io.fetch import settings
+    return os.path.join(settings["cachedir"],"templates-{}.bin".format(sourcehash()))
+
+
+def _chi(template,ichi):
+    return [template.chi1,template.chi2,template.chi3,template.chi4][ichi]
+
+
+def compile_library(filename):
+    """
+    Build all the templates from their source modules and store them,
+    together with their connectivity and torsion trees, in a single
+    binary file
+    """
+    from ptmpsi.io.snapshot import writecontainer
+
+    keys, templates, modules = [], [], []
+    for module in _modules:
+        _module = importlib.import_module("ptmpsi.residues."+module)
+        for key,value in vars(_module).items():
+            if isinstance(value,Template):
+                keys.append(key)
+                templates.append(value)
+                modules.append(module)
+
+    natoms = [len(template.coordinates) for template in templates]
+    atomoffsets = np.append(0,np.cumsum(natoms))
+
+    # Side-chain dihedrals (-1 if undefined) and their moving atoms
+    chis = np.full((len(templates),4,4),-1,dtype='<i8')
+    nmoving = np.full((len(templates),4),-1,dtype='<i8')
+    moving = []
+    for itemplate,template in enumerate(templates):
+        for ichi,chi in enumerate(template.chis):
+            chis[itemplate,ichi] = chi
+        for ichi,atoms in enumerate(template.torsions):
+            if atoms is None: continue
+            nmoving[itemplate,ichi] = len(atoms)
+            moving.append(atoms)
+
+    # Connectivity in compressed sparse row format
+    neighbors = [ neighbor for template in templates for neighbor in template.adjacency ]
+    neighboroffsets = np.append(0,np.cumsum([len(neighbor) for neighbor in neighbors]))
+
+    arrays = {
+        "elements":    np.concatenate([np.asarray(template.elements).astype(str) for template in templates]),
+        "coordinates": np.concatenate([template.coordinates for template in templates]).astype('<f8'),
+        "atomoffsets": atomoffsets.astype('<i8'),
+        "backbone":    np.array([np.asarray(template.backbone).astype(int) for template in templates],dtype='<i8'),
+        "nattach":     np.array([template.nattach for template in templates],dtype='<f8'),
+        "cattach":     np.array([template.cattach for template in templates],dtype='<f8'),
+        "chis":        chis,
+        "nmoving":     nmoving,
+        "moving":      np.concatenate(moving+[np.empty(0,dtype=int)]).astype('<i8'),
+        "neighbors":   np.concatenate(neighbors+[np.empty(0,dtype=int)]).astype('<i8'),
+        "neighboroffsets": neighboroffsets.astype('<i8'),
+    }
+    header = {
+        "keys":      keys,
+        "modules":   modules,
+        "names":     [template.name for template in templates],
+        "fullnames": [template.fullname for template in templates],
+        "pkas":      [template.pka for template in templates],
+    }
+
+    # Write to a temporary file first, other processes may be reading
+    os.makedirs(os.path.dirname(filename),exist_ok=True)
+    tmp = "{}.{}".format(filename,os.getpid())
+    writecontainer(tmp,header,arrays,_MAGIC)
+    os.replace(tmp,filename)
+    return
+
+
+class TemplateLibrary:
+    """
+    Residue templates loaded from the compiled library file with a
+    single memory map. Templates are assembled from views into the
+    mapped arrays the first time they are requested.
+    """
+    def __init__(self,filename):
+        from ptmpsi.io.snapshot import readcontainer
+        header, self.arrays = readcontainer(filename,True,_MAGIC)
+        self.header = header
+        self.index = { (module,key): itemplate for itemplate,(module,key) in enumerate(zip(header["modules"],header["keys"])) }
+        self.templates = {}
+        return
+
+
+    def __contains__(self,entry):
+        return tuple(entry) in self.index
+
+
+    def get(self,module,key):
+        itemplate = self.index[(module,key)]
+        if itemplate not in self.templates:
+            self.templates[itemplate] = self.build(itemplate)
+        return self.templates[itemplate]
+
+
+    def build(self,itemplate):
+        arrays = self.arrays
+        start, stop = arrays["atomoffsets"][itemplate], arrays["atomoffsets"][itemplate+1]
+
+        template = Template()
+        template.name = self.header["names"][itemplate]
+        template.fullname = self.header["fullnames"][itemplate]
+        template.pka = self.header["pkas"][itemplate]
+        template.elements = arrays["elements"][start:stop]
+        template.coordinates = arrays["coordinates"][start:stop]
+        template.backbone = arrays["backbone"][itemplate]
+        template.nattach = arrays["nattach"][itemplate]
+        template.cattach = arrays["cattach"][itemplate]
+
+        chis = [ chi if chi[0] >= 0 else None for chi in arrays["chis"][itemplate] ]
+        template.chi1, template.chi2, template.chi3, template.chi4 = chis
+
+        # Precompiled torsion tree and connectivity
+        offset = int(np.sum(np.maximum(arrays["nmoving"][:itemplate],0)))
+        torsions = []
+        for nmoving in arrays["nmoving"][itemplate][:len(template.chis)]:
+            if nmoving < 0:
+                torsions.append(None)
+                continue
+            torsions.append(arrays["moving"][offset:offset+nmoving])
+            offset += nmoving
+        template._torsions = torsions
+
+        offsets = arrays["neighboroffsets"][start:stop+1]
+        template._adjacency = [ arrays["neighbors"][offsets[iatom]:offsets[iatom+1]] for iatom in range(stop-start) ]
+        return template
+
+
+def library():
+    """
+    Compiled template library, rebuilt whenever the template sources
+    change or the file is corrupt. Returns None if the library cannot
+    be written or read.
+    """
+    global _library
+    if _library is None:
+        corrupt = (ValueError,KeyError,MyDockingError)
+        try:
+            filename = libraryfile()
+            if not os.path.isfile(filename):
+                compile_library(filename)
+            try:
+                _library = TemplateLibrary(filename)
+            except corrupt:
+                # Truncated or damaged file, replace it with a new one
+                compile_library(filename)
+                _library = TemplateLibrary(filename)
+        except (OSError,) + corrupt:
+            _library = False
+    return _library or None
+
+
+def template(module,key):
+    """
+    Template key defined in module, taken from the compiled library
+    if possible, or from the source module otherwise
+    """
+    _library = library()
+    if (_library is not None) and ((module,key) in _library):
+        return _library.get(module,key)
+    return getattr(importlib.import_module("ptmpsi.residues."+module),key)
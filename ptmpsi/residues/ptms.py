@@ -1,6 +1,7 @@
 import numpy as np
 from ptmpsi.constants import amidebond, pobond, nhbond
 from ptmpsi.math import nerf, rotmatvec, get_torsion, rotmataxis
+from ptmpsi.exceptions import MyDockingError
 
 class PTM:
     def __init__(self):
@@ -96,18 +97,14 @@ ptmsite = {
         "TYR": ["CD1","CE1","OH"],
         }
 
-def doptm(residue,radical,bond,angle,dihedral,argdimeth=False):
+def doptm(residue,radical,bond,angle,dihedral,argdimeth=False,hissite="ask"):
 
+    # Save the residue in the open transaction (if any)
+    residue._checkpoint()
 
-    # Ask for attachment site
+    # Select attachment site
     if residue.name in ["HIS","HIP","HID","HIE"]:
-        print("\n\t Which histidine position should react?")
-        print("\t\t 1. Pros (pi) position")
-        print("\t\t 2. Tele (tau) position")
-        position = input("\t Selection: ").lower()
-        if position not in ["1","2","pros","tele"]:
-            raise MyDockingError("Could not understand selection '{}'".format(position))
-        site = ptmsite["pros" if position in ["1","pros"] else "tele"]
+        site = ptmsite[select_hissite(residue,radical,bond,angle,dihedral,hissite)]
     elif argdimeth:
         site = ["NE","CZ","NH2"]
     else:
@@ -129,15 +126,8 @@ def doptm(residue,radical,bond,angle,dihedral,argdimeth=False):
         residue.coordinates = residue.coordinates[mask]
         residue.natoms = len(mask)
 
-    # Define attachment point
-    pos1 = residue.find_coord(site[2])
-    pos2 = nerf(residue.find_coord(site[0]), residue.find_coord(site[1]),
-                pos1,bond,angle,dihedral) - pos1
-
-
-    # Align radical
-    R = -rotmatvec(pos2,radical.attach)
-    newcoords = np.dot(radical.coordinates,R.T) + pos1 + pos2
+    # Define attachment point and align radical
+    newcoords = attachment(residue,radical,site,bond,angle,dihedral)
 
     # Attach radical
     residue.coordinates = np.vstack((residue.coordinates,newcoords))
@@ -162,6 +152,7 @@ def doptm(residue,radical,bond,angle,dihedral,argdimeth=False):
             mask = [ i for i,x in enumerate(residue.names) if x in radical.names ]
             temp = residue.coordinates[mask] - residue.find_coord(site[2])
             temp = np.dot(temp,R.T) + residue.find_coord(site[2])
+            residue._unshare()
             residue.coordinates[mask] = temp
             dihedral = get_torsion(residue.find_coord(site[1]),
                 residue.find_coord(site[2]),residue.find_coord(site3),
@@ -171,6 +162,70 @@ def doptm(residue,radical,bond,angle,dihedral,argdimeth=False):
     return
 
 
+def attachment(residue,radical,site,bond,angle,dihedral):
+    """
+    Coordinates of the radical attached to atom site[2] of residue
+    """
+    pos1 = residue.find_coord(site[2])
+    pos2 = nerf(residue.find_coord(site[0]), residue.find_coord(site[1]),
+                pos1,bond,angle,dihedral) - pos1
+    R = -rotmatvec(pos2,radical.attach)
+    return np.dot(radical.coordinates,R.T) + pos1 + pos2
+
+
+def select_hissite(residue,radical,bond,angle,dihedral,policy="ask"):
+    """
+    Histidine nitrogen ("pros" or "tele") that reacts, following policy:
+        "ask":         prompt for it
+        "pros"/"tele": always the given one ("1"/"2" are also valid)
+        "protonation": the nitrogen holding a hydrogen, which is replaced.
+                       Falls back to "clashes" if both or none are protonated
+        "clashes":     the one where the radical has fewer clashes with
+                       the rest of the protein (tele on ties)
+    """
+    policy = str(policy).lower()
+    if policy == "ask":
+        print("\n\t Which histidine position should react?")
+        print("\t\t 1. Pros (pi) position")
+        print("\t\t 2. Tele (tau) position")
+        policy = input("\t Selection: ").lower()
+        if policy not in ["1","2","pros","tele"]:
+            raise MyDockingError("Could not understand selection '{}'".format(policy))
+    if policy in ["1","pros"]: return "pros"
+    if policy in ["2","tele"]: return "tele"
+
+    if policy == "protonation":
+        pros = "HD1" in residue.names
+        tele = "HE2" in residue.names
+        if pros != tele:
+            return "pros" if pros else "tele"
+        policy = "clashes"
+    if policy == "clashes":
+        positions = ["tele","pros"]
+        candidates = np.stack([attachment(residue,radical,ptmsite[position],bond,angle,dihedral) for position in positions])
+        clashes = radical_clashes(residue,radical,candidates)
+        return positions[int(np.argmin(clashes))]
+    raise MyDockingError("Unknown histidine site policy '{}'".format(policy))
+
+
+def radical_clashes(residue,radical,candidates):
+    """
+    Count the clashes of every candidate placement (K,n,3) of a radical
+    on residue with the rest of the protein, in a single pass
+    """
+    from ptmpsi.math.neighbors import NeighborIndex, atomflags, clashing
+    clashes = np.zeros(len(candidates),dtype=int)
+    if residue._protein is None:
+        return clashes
+    index = NeighborIndex([residue._protein],candidates.reshape(-1,3))
+    iatom, jatom, distance = index.query(candidates.reshape(-1,3))
+    same = (index.resid[jatom] == residue.resid) & (index.chain[jatom] == residue.chain)
+    iflags = atomflags(np.tile(radical.names,len(candidates)))[iatom]
+    mask = ~same & clashing(iflags,residue.resid,residue.chain,
+                            index.flags[jatom],index.resid[jatom],index.chain[jatom],distance)
+    return np.bincount(iatom[mask]//radical.natoms,minlength=len(candidates))
+
+
 def check_ptm(residue,ptm):
     if ptm == 'phosphorylation':
         # Check that the residue can be phosphorylated
@@ -224,6 +279,7 @@ def get_ptm_name(original,ptm):
 
 
 def add_hydrogens(residue,ptm):
+    residue._checkpoint()
     if (residue.name in ["LYS","LYN"]) and (ptm != "trimethylation"):
         if ptm in ["methylation","dimethylation"]:
             angle = 109
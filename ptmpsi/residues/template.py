@@ -1,5 +1,6 @@
 import numpy as np
 from ptmpsi.exceptions import MyDockingError
+from ptmpsi.math import bonds, moving_atoms
 
 class Template:
     def __init__(self):
@@ -13,16 +14,72 @@ class Template:
         self.pka = None
         self.chi1 = None
         self.chi2 = None
+        self.chi3 = None
+        self.chi4 = None
+        self._torsions = None
+        self._adjacency = None
+
+    @property
+    def elements(self):
+        return self._elements
+
+    @elements.setter
+    def elements(self,value):
+        self._elements = value
+        self._lookup = None
+        self._torsions = None
+        self._adjacency = None
+
+    def _nameindex(self):
+        # Name to position map, rebuilt only after elements are reassigned.
+        # The first occurrence of a repeated name wins.
+        if self._lookup is None:
+            names = self._elements[:,1].tolist()
+            self._lookup = dict(zip(reversed(names),range(len(names)-1,-1,-1)))
+        return self._lookup
 
     def find(self,atom):
         if self.elements is None:
             raise MyDockingError("Template was not initialized")
-        pos = next((idx for idx,val in np.ndenumerate(self.elements[:,1]) if val==atom),None)
+        pos = self._nameindex().get(atom)
         if pos is None:
             raise MyDockingError("Atom '{}' was not found in Template '{}'".format(atom,self.name))
-        return pos[0]
+        return pos
+
+    def find_many(self,atoms):
+        return np.array([self.find(atom) for atom in atoms],dtype=int)
 
 
     def find_coord(self,atom):
         return self.coordinates[self.find(atom)]
 
+    @property
+    def chis(self):
+        """
+        Side-chain dihedrals defined for this template, in order
+        """
+        chis = []
+        for chi in [self.chi1, self.chi2, self.chi3, self.chi4]:
+            if chi is None: break
+            chis.append(chi)
+        return chis
+
+    @property
+    def adjacency(self):
+        """
+        Bonded neighbors of every atom of the template
+        """
+        if self._adjacency is None:
+            self._adjacency = bonds(self.elements[:,0],self.coordinates)
+        return self._adjacency
+
+    @property
+    def torsions(self):
+        """
+        Torsion tree of the template: the atoms that move with
+        each of its side-chain dihedrals. Compiled on first use.
+        """
+        if self._torsions is None:
+            self._torsions = [moving_atoms(self.adjacency,chi[1:3]) for chi in self.chis]
+        return self._torsions
+
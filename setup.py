@@ -2,7 +2,7 @@ from setuptools import setup
 
 setup(
         name='ptmpsi',
-        description='A Python Package to Facilitate the Computational Investigation of Post-Translational Modification on Protein Structures and Their Impacts on Dynamics and Functions'
+        description='A Python Package to Facilitate the Computational Investigation of Post-Translational Modification on Protein Structures and Their Impacts on Dynamics and Functions',
         version='0.1',
         author='Daniel Mejia-Rodriguez',
         author_email='daniel.mejia@pnnl.gov',
@@ -23,4 +23,7 @@ setup(
             'torsiondrive @ git+https://github.com/dmejiar/torsiondrive.git@nwchem ',
             'forcebalance @ git+https://github.com/dmejiar/forcebalance.git@ptmflow '
         ],
+        extras_require={
+            'bcif': ['msgpack'],
+        },
     )